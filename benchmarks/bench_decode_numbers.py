@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: Apache-2.0
+
+"""Time JdotDecoder.decode on number-heavy records, like telemetry dumps.
+
+Each record has a few ints and floats, a bare word that is not a number,
+and a keyword.  Tokenizing and decoding are timed separately."""
+
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0])
+
+from jdot import JdotCoder  # noqa: E402
+
+
+def make_text(nrecords):
+    rnd = random.Random(0)
+    return "\n".join(
+        f"{{ .id {i} .ts {1700000000 + i} .cpu {rnd.random():.4f} "
+        f".mem {rnd.randrange(1 << 30)} .load [ {rnd.random():.2f} "
+        f"{rnd.random():.2f} {rnd.random():.2f} ] .host web{i % 50} .ok true }}"
+        for i in range(nrecords)
+    )
+
+
+def best_of(repeat, f):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tokenizer", default="regex")
+    parser.add_argument("counts", type=int, nargs="*", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    for nrecords in args.counts:
+        j = JdotCoder(tokenizer=args.tokenizer)
+        s = make_text(nrecords)
+        tokenize = best_of(args.repeat, lambda: list(j.tokenize(s)))
+        decode = best_of(args.repeat, lambda: j.decode(s))
+        print(
+            f"{nrecords:6d} records  tokenize {tokenize * 1000:9.1f} ms"
+            f"  decode {decode * 1000:9.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: Apache-2.0
+
+"""Time JdotEncoder.encode against the number of macros defined.
+
+Each macro pins a different value of "type", so only one of them can match
+any given record; with the macro index, encode time should stay roughly
+flat as the number of macros grows.  --linear tries every macro on every
+dict, as the encoder did before the index."""
+
+import sys
+import time
+import argparse
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0])
+
+from jdot import JdotCoder  # noqa: E402
+
+
+def make_coder(nmacros):
+    j = JdotCoder()
+    defs = " ".join(f'.t{i} <.type "t{i}" .value ?v{i}>' for i in range(nmacros))
+    j.decode("@macros " + defs)
+    return j
+
+
+def make_records(nrecords, nmacros):
+    return [
+        dict(type=f"t{i % nmacros}", value=i, extra=dict(n=i, s=str(i)))
+        for i in range(nrecords)
+    ]
+
+
+def linear(j):
+    j.macroindex.candidates = lambda obj, start=0: [
+        (i, *item) for i, item in enumerate(j.macroindex.items) if i >= start
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--linear", action="store_true")
+    parser.add_argument("counts", type=int, nargs="*", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    for nmacros in args.counts:
+        j = make_coder(nmacros)
+        j.encode_oneliner({})  # builds the macro index
+        if args.linear:
+            linear(j)
+        records = make_records(args.records, nmacros)
+        best = None
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            j.encode_oneliner(records)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{nmacros:6d} macros  {best * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: Apache-2.0
+
+"""Time JdotEncoder.encode_parallel against the number of worker processes.
+
+The records are like those of bench_encode_macros.py, with a library of
+macros that each match only some of them.  The serial time is encode(); the
+output of encode_parallel() is checked to be the same."""
+
+import sys
+import time
+import argparse
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0])
+
+from jdot import JdotCoder  # noqa: E402
+
+
+def make_coder(nmacros):
+    j = JdotCoder()
+    defs = " ".join(
+        f'.t{i} <.type "t{i}" .value ?v{i} .extra {{ .n ?n{i} .s ?s{i} }}>'
+        for i in range(nmacros)
+    )
+    j.decode("@macros " + defs)
+    return j
+
+
+def make_records(nrecords, nmacros):
+    return [
+        dict(type=f"t{i % nmacros}", value=i, extra=dict(n=i, s=str(i)), tags=[i])
+        for i in range(nrecords)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--macros", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("workers", type=int, nargs="*", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    j = make_coder(args.macros)
+    records = make_records(args.records, args.macros)
+    expected = j.encode(records)
+
+    for workers in args.workers:
+        best = None
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            if workers == 1:
+                out = j.encode(records)
+            else:
+                out = j.encode_parallel(records, workers)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+            assert out == expected
+        print(f"{workers:3d} workers  {best * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: Apache-2.0
+
+"""Time getting a coder ready to encode with a library of macros.
+
+"decode" decodes the macros from text, then builds the macro index and
+compiles every matcher and template, as encoding and decoding eventually
+would.  "snapshot" loads them all from a snapshot instead."""
+
+import sys
+import time
+import argparse
+
+sys.path.insert(0, __file__.rsplit("/", 2)[0])
+
+from jdot import JdotCoder, snapshot  # noqa: E402
+from jdot.decoder import CompiledTemplate  # noqa: E402
+
+
+def make_library(nmacros):
+    return "@macros " + " ".join(
+        f'.t{i} <.type "t{i}" .value ?v{i} .extra {{ .n ?n{i} .s ?s{i} }}>'
+        for i in range(nmacros)
+    )
+
+
+def from_text(text):
+    j = JdotCoder()
+    j.decode(text)
+    j.encode_oneliner({})  # builds the macro index
+    j.macroindex.compile()
+    for name, template in j.macros.items():
+        j.compiled_macros[name] = CompiledTemplate(template)
+    return j
+
+
+def best_of(repeat, f):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("counts", type=int, nargs="*", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    for nmacros in args.counts:
+        text = make_library(nmacros)
+        data = snapshot.dumps(from_text(text))
+        decode = best_of(args.repeat, lambda: from_text(text))
+        load = best_of(args.repeat, lambda: snapshot.loads(data))
+        print(
+            f"{nmacros:6d} macros  decode {decode * 1000:9.1f} ms"
+            f"  snapshot {load * 1000:9.1f} ms ({len(data)} bytes)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,20 +3,48 @@
 import sys
 
 
-from .jdot import deep_match
+from .jdot import deep_match, Macros
 from .encoder import JdotEncoder
 from .decoder import JdotDecoder
-from .formatter import JdotFormatter
+from .cache import DecodeCache
+from .frozen import FrozenMacros
+from .mining import MacroMiner, MinedMacro, mine_macros
+from . import snapshot
+from .formatter import JdotFormatter, JdotStreamFormatter
 
 
 class JdotCoder(JdotEncoder, JdotDecoder):
-    def __init__(self, **kwargs):
+    def __init__(self, decode_cache=None, frozen=None, **kwargs):
         super().__init__()
         self.toktuple = None
-        self.options = dict(debug=False, strict=False)
+        self._pushstate = None
+        self.decode_cache = decode_cache  # DecodeCache used by decode()
+        self.frozen = frozen  # FrozenMacros shared with other coders
+        self.options = dict(debug=False, strict=False, tokenizer="regex", match_memo=0)
+        if frozen is not None:
+            self.options.update(frozen.options)
         self.options.update(kwargs)
-        self.macros = dict()
+        self.macros = frozen.macros.copy() if frozen is not None else Macros()
+        self.compiled_macros = dict()  # macro name -> CompiledTemplate
         self.globals = dict(macros=self.macros, options=self.options)
+        if frozen is not None:
+            self.restart()
+
+    def freeze(self) -> FrozenMacros:
+        """Return the macros and options, compiled and frozen to be shared by
+        other coders (made with its coder() method).  This coder shares them
+        too, until it defines macros of its own."""
+        self.frozen = FrozenMacros(self)
+        return self.frozen
+
+    def dump_snapshot(self, fp, precompile=True):
+        """Write the macros and options, compiled, to binary file object *fp*,
+        to be loaded by load_snapshot() without decoding them again."""
+        snapshot.dump(self, fp, precompile)
+
+    def load_snapshot(self, fp):
+        "Replace the macros and update the options from a dump_snapshot() file."
+        snapshot.load(fp, self)
 
     def debug(self, *args, **kwargs):
         if self.options["debug"]:
@@ -32,5 +60,11 @@ __all__ = [
     "JdotEncoder",
     "JdotCoder",
     "JdotFormatter",
+    "JdotStreamFormatter",
+    "DecodeCache",
+    "FrozenMacros",
+    "MacroMiner",
+    "MinedMacro",
+    "mine_macros",
     "deep_match",
 ]
@@ -5,7 +5,8 @@ import sys
 import json
 import argparse
 
-from jdot import JdotCoder, JdotFormatter
+from jdot import JdotCoder, JdotFormatter, JdotStreamFormatter, MacroMiner
+from jdot.mining import iterjson
 
 
 def json2jdot(s):
@@ -26,10 +27,14 @@ def jdot2json(s):
     return json.dumps(d, cls=JsonDefaultEncoder)
 
 
-def read_arg(fn):
+def open_arg(fn):
     if fn == "-":
-        return sys.stdin.read()
-    return open(fn).read()
+        return sys.stdin
+    return open(fn)
+
+
+def read_arg(fn):
+    return open_arg(fn).read()
 
 
 def iterobjs(d):
@@ -49,6 +54,34 @@ def argparser():
     inputs.add_argument(
         "-e", "-n", "--in-json", dest="in_json", type=str, required=False, action='append', nargs='?'
     )
+    inputs.add_argument(
+        "--load-snapshot",
+        type=str,
+        required=False,
+        help="load macros and options from a snapshot written by --save-snapshot",
+    )
+    parser.add_argument(
+        "--save-snapshot",
+        type=str,
+        required=False,
+        help="write the macros and options, compiled, to a snapshot file",
+    )
+    parser.add_argument(
+        "--mine-macros",
+        action="store_true",
+        required=False,
+        help="""
+        instead of converting the inputs, print the @macros that would shrink
+        them the most as jdot, read in one pass (JSON inputs as JSON Lines)
+        """,
+    )
+    parser.add_argument(
+        "--mine-limit",
+        type=int,
+        default=20,
+        required=False,
+        help="number of macros to suggest with --mine-macros (defaults to 20)",
+    )
     out_format = parser.add_mutually_exclusive_group(required=False)
     out_format.add_argument(
         "-j",
@@ -62,6 +95,12 @@ def argparser():
         "-m", "--out-jdot", dest="out_json", action="store_false", required=False
     )
     parser.add_argument("--debug", action="store_true", default=False, required=False)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        required=False,
+        help="encode top-level values to jdot in this many processes",
+    )
     format_options = parser.add_argument_group("Format options")
     format_options.add_argument(
         "-p",
@@ -132,6 +171,15 @@ def argparser():
         entries sorted by increasing size.
     """,
     )
+    format_options.add_argument(
+        "--lookahead",
+        type=int,
+        required=False,
+        help="""
+        pretty-print the output as it is produced, deciding how to lay out each
+        group from at most this many tokens ahead.
+        """,
+    )
     ordering = format_options.add_mutually_exclusive_group(required=False)
     ordering.add_argument("--order-by-key", action="store_true", required=False)
     ordering.add_argument("--order-by-size", action="store_true", required=False)
@@ -149,10 +197,25 @@ def main():
     argv = sys.argv[1:]
     args, jdotargs = argparser().parse_known_args(argv)
 
+    if args.load_snapshot:
+        with open(args.load_snapshot, "rb") as fp:
+            j.load_snapshot(fp)
+    if args.mine_macros:
+        miner = MacroMiner()
+        for f_jdot in args.in_jdot or []:
+            for obj in j.iterdecode_objects(open_arg(f_jdot)):
+                miner.add(obj)
+        for f_json in args.in_json or []:
+            for obj in iterjson(open_arg(f_json)):
+                miner.add(obj)
+        if jdotargs:
+            miner.add(j.decode(" ".join(jdotargs)))
+        sys.stdout.write(miner.format(args.mine_limit))
+        return
+
     if args.in_jdot:
         for f_jdot in args.in_jdot:
-            d = j.decode(read_arg(f_jdot))
-            objs.extend(iterobjs(d))
+            objs.extend(j.iterdecode_objects(open_arg(f_jdot)))
             args.out_json = True
     if args.in_json:
         for f_json in args.in_json:
@@ -181,26 +244,43 @@ def main():
         d = j.decode(" ".join(jdotargs))
         objs.extend(iterobjs(d))
 
+    if args.save_snapshot:
+        with open(args.save_snapshot, "wb") as fp:
+            j.dump_snapshot(fp)
+
     if objs:
         if args.out_json:
             if args.pretty_print:
                 indent = args.indent
             else:
                 indent = None
-            print(
-                json.dumps(
-                    objs,
-                    cls=JsonDefaultEncoder,
-                    sort_keys=(sort_key == "key"),
-                    indent=indent,
-                )
+            json.dump(
+                objs,
+                sys.stdout,
+                cls=JsonDefaultEncoder,
+                sort_keys=(sort_key == "key"),
+                indent=indent,
             )
+            print()
         else:
             if args.pretty_print:
-                formatter = JdotFormatter(**format_options)
+                format_options = {
+                    k: v for k, v in format_options.items() if v is not None
+                }
+                if args.lookahead:
+                    formatter = JdotStreamFormatter(
+                        lookahead=args.lookahead, **format_options
+                    )
+                else:
+                    formatter = JdotFormatter(**format_options)
             else:
                 formatter = None
-            print(j.encode(objs, formatter, sort_key))
+            if args.jobs:
+                out = j.encode_parallel(objs, args.jobs, formatter, sort_key)
+                sys.stdout.write(out)
+            else:
+                j.dump(objs, sys.stdout, formatter, sort_key)
+            print()
 
 
 if __name__ == "__main__":
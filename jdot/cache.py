@@ -0,0 +1,154 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+import collections
+
+from .jdot import Macros
+
+__all__ = ["DecodeCache", "CacheInfo"]
+
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", "hits misses disk_hits maxsize currsize"
+)
+
+# part of every key, so that entries written by an incompatible version of
+# the cache are never read back
+_FORMAT = b"jdot-decode-cache-2\0"
+
+
+class DecodeCache:
+    """Results of JdotDecoder.decode(), keyed by a hash of the input text and
+    of the macros and options in effect.  Decoding can define macros and set
+    options, so an entry for a decode that changed them also keeps the
+    macros and options that were in effect afterwards, and a hit puts them
+    back as a decode would have.
+
+    Entries are kept pickled, so every hit returns a new copy that is safe to
+    change.  At most *maxsize* entries are kept in memory, dropping the least
+    recently used.  If *directory* is given, entries are also written there
+    and read back on a miss in memory, so they outlive the process; only use a
+    directory that no one else can write to, as entries are unpickled.
+
+    One cache can be shared by any number of coders and threads."""
+
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = collections.OrderedDict()  # key -> pickled entry
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0  # hits read from *directory*, also counted in hits
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, s: str, macros: dict, options: dict) -> str:
+        "The key for decoding *s* with *macros* and *options*."
+        if not isinstance(macros, Macros):
+            macros = Macros(macros)
+        h = hashlib.sha256(_FORMAT)
+        h.update(macros.fingerprint())  # kept until the macros change
+        h.update(pickle.dumps(options, protocol=pickle.HIGHEST_PROTOCOL))
+        h.update(s.encode("utf-8", "surrogatepass"))
+        return h.hexdigest()
+
+    def decode(self, coder, s: str):
+        "Decode *s* with *coder*, or return a copy of the cached result."
+        key = self.key(s, coder.macros, coder.options)
+        data = self.get(key)
+        if data is not None:
+            ret, macros, options, output = pickle.loads(data)
+            if macros is not None:  # changed by the decode
+                coder.macros.clear()  # update in place, as @macros would
+                coder.macros.update(macros)
+            if options is not None:
+                coder.options.clear()
+                coder.options.update(options)
+            coder.globals["output"] = ret if output else None
+            return ret
+
+        fingerprint = coder.macros.fingerprint()
+        options = dict(coder.options)
+        ret = coder.iterdecode(coder.tokenize(s))
+        output = coder.globals.get("output") is ret
+        macros = coder.macros if coder.macros.fingerprint() != fingerprint else None
+        options = coder.options if coder.options != options else None
+        entry = (ret, macros, options, output)
+        self.put(key, pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+        return ret
+
+    def get(self, key: str):
+        "Return the pickled entry for *key*, or None, and count the hit or miss."
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._read(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+                self._store(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        "Add pickled entry *data* for *key*."
+        with self.lock:
+            self._store(key, data)
+        self._write(key, data)
+
+    def _store(self, key, data):
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def _write(self, key, data):
+        if self.directory is None:
+            return
+        # write to a temporary file first, so readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def cache_info(self) -> CacheInfo:
+        "Hit and miss statistics, like functools.lru_cache."
+        with self.lock:
+            return CacheInfo(
+                self.hits, self.misses, self.disk_hits, self.maxsize, len(self.entries)
+            )
+
+    def clear(self):
+        "Drop the entries in memory (not on disk) and reset the statistics."
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.disk_hits = 0
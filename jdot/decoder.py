@@ -1,44 +1,391 @@
 # SPDX-License-Identifier: Apache-2.0
 
-from dataclasses import dataclass
-from typing import Tuple, Iterator, Union
-
-from .jdot import InnerDict, deep_update, Variable
+import re
+import copy
+import asyncio
+import codecs
+import collections
+from typing import Tuple, Iterator, List, Union
+
+from .jdot import (
+    InnerDict,
+    deep_update,
+    Variable,
+    function_state,
+    restore_function,
+)
 
 COMMENT_CHAR = "#"
 
+# Token kinds, which _iterdecode() dispatches on
+_STR = "str"  # string literal
+_VARIABLE = "variable"  # ?name
+_GLOBAL = "global"  # @name
+_KEY = "key"  # .name
+_INT = "int"
+_FLOAT = "float"
+_KEYWORD = "keyword"  # true, false, null
+_OPEN = "open"  # { < [
+_CLOSE = "close"  # } > ]
+_MACRO_OPEN = "macro open"  # (
+_MACRO_CLOSE = "macro close"  # )
+_DEBUG = "debug"  # !
+_WORD = "word"  # anything else
+
+_KEYWORDS = {"true": True, "false": False, "null": None}
+_OPENERS = {"{": dict, "<": InnerDict, "[": list}
+
+_fixed_kinds = {
+    **dict.fromkeys(_KEYWORDS, _KEYWORD),
+    **dict.fromkeys(_OPENERS, _OPEN),
+    **dict.fromkeys("}>]", _CLOSE),
+    "(": _MACRO_OPEN,
+    ")": _MACRO_CLOSE,
+    "!": _DEBUG,
+}
+_prefix_kinds = {"?": _VARIABLE, "@": _GLOBAL, ".": _KEY}
+_number_re = re.compile(
+    r"(?P<int>[-+]?[0-9]+)|(?:[-+]?[0-9]+\.?[0-9]*|[-+]?\.[0-9]+)(?:[eE][-+]?[0-9]+)?"
+)
+# other words int() or float() might take, such as 1_000 or inf
+_maybe_number_re = re.compile(r"[-+]?(?:\d|\.|inf|nan)", re.IGNORECASE)
+
+
+def _word_kind(tok: str) -> str:
+    "Classify a bare word that is not a keyword, bracket or prefixed name."
+    if tok.isdigit() and tok.isascii():
+        return _INT
+    m = _number_re.fullmatch(tok)
+    if m is None:
+        return _WORD
+    return _FLOAT if m["int"] is None else _INT
+
+
+def _token_kind(type: str, string: str) -> str:
+    "Classify a token, as _iterdecode() would by looking at it."
+    if type == "str":
+        return _STR
+    return (
+        _fixed_kinds.get(string) or _prefix_kinds.get(string[:1]) or _word_kind(string)
+    )
+
 
-@dataclass
 class Token:
-    type: str
-    string: str
-    start: Tuple[int, int]
-    end: Tuple[int, int]
-    line: str
+    """A token and where it came from.  *line* is the source line the token
+    ends on; start and end positions are only built when asked for.  *kind*
+    classifies the token for the decoder."""
+
+    __slots__ = ("type", "string", "kind", "linenum", "col", "endcol", "line")
+
+    def __init__(self, type, string, linenum, col, endcol, line, kind=None):
+        self.type = type
+        self.string = string
+        self.kind = kind or _token_kind(type, string)
+        self.linenum = linenum
+        self.col = col
+        self.endcol = endcol
+        self.line = line
+
+    @property
+    def start(self) -> Tuple[int, int]:
+        return (self.linenum, self.col)
+
+    @property
+    def end(self) -> Tuple[int, int]:
+        return (self.linenum, self.endcol)
 
     def __str__(self):
         return f"{self.string} (line {self.start[0]}, col {self.start[1]})"
 
+    def __repr__(self):
+        return (
+            f"Token({self.type!r}, {self.string!r}, "
+            f"start={self.start}, end={self.end})"
+        )
+
+
+class MultilineToken(Token):
+    "A string literal that ends on a later line than it starts."
+
+    __slots__ = ("endlinenum",)
+
+    def __init__(self, type, string, linenum, col, endlinenum, endcol, line):
+        super().__init__(type, string, linenum, col, endcol, line)
+        self.endlinenum = endlinenum
+
+    @property
+    def end(self) -> Tuple[int, int]:
+        return (self.endlinenum, self.endcol)
+
 
 ESCAPE_CHARS = {"n": "\n", "\\": "\\", '"': '"'}
 
 
+# the next backslash or closing delimiter in a string literal
+_string_stop_res = {delim: re.compile(r"\\|" + re.escape(delim)) for delim in "\"'"}
+_string_stop_res[""] = re.compile(r"\\")
+
+
 def parse_escaped_str(s: str, i: int = 0, delim: str = ""):
-    string = ""
-    while i < len(s):
-        ch = s[i]
-        i += 1
+    stop_re = _string_stop_res.get(delim)
+    if stop_re is None:
+        stop_re = _string_stop_res[delim] = re.compile(r"\\|" + re.escape(delim))
+    pieces = []
+    while True:
+        m = stop_re.search(s, i)
+        if m is None:
+            pieces.append(s[i:])
+            return "".join(pieces), len(s)  # not finished
+
+        j = m.start()
+        pieces.append(s[i:j])
+        if s[j] != "\\":
+            return "".join(pieces), m.end()
+
+        ch = s[j + 1]
+        pieces.append(ESCAPE_CHARS.get(ch, ch))  # next character, itself by default
+        i = j + 2
+
+
+_escape_re = re.compile(r"\\(.)", re.DOTALL)
+
+
+def unescape(s: str) -> str:
+    "Return *s* with its backslash escapes replaced, as by parse_escaped_str."
+    if "\\" not in s:
+        return s
+    return _escape_re.sub(lambda m: ESCAPE_CHARS.get(m[1], m[1]), s)
+
+
+# One match per token: a comment, a bracket, or a bare word optionally
+# followed by a quoted string (as in `."quoted key"`).  A quote that is not
+# closed on the same line matches as `open` and is continued by the tokenizer.
+_token_re = re.compile(
+    r"""
+    (?P<comment>\#)
+    | (?P<bracket>[][{}()<>])
+    | (?=[^\s#])(?P<word>[^\s\][{}()<>#"']*)
+      (?:
+        (?P<str>"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*')
+        | (?P<open>["'])
+      )?
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def _iterlines(s: Union[str, Iterator[str]]) -> Iterator[str]:
+    if isinstance(s, str):
+        return iter(x + "\n" for x in s.splitlines())
+    return iter(s)
+
+
+class LineSplitter:
+    """Split text pushed in arbitrary chunks into lines ending in newline.
+    Bytes are decoded as utf-8.  A line longer than *maxlen* is handed out in
+    pieces that end in whitespace, so that only a string literal can span
+    pieces; positions in error messages are then relative to the piece."""
+
+    def __init__(self, maxlen=65536):
+        self.maxlen = maxlen
+        self.pending = []  # pieces of the current, incomplete line
+        self.pendinglen = 0
+        self.bytesdecoder = None
+
+    def push(self, chunk: Union[str, bytes]) -> List[str]:
+        "Add *chunk* and return the lines (or pieces of line) it completed."
+        if isinstance(chunk, bytes):
+            if self.bytesdecoder is None:
+                self.bytesdecoder = codecs.getincrementaldecoder("utf-8")()
+            chunk = self.bytesdecoder.decode(chunk)
+
+        lines = chunk.split("\n")
+        last = lines.pop()
+        if lines:
+            self.pending.append(lines[0])
+            lines[0] = "".join(self.pending)
+            lines = [x + "\n" for x in lines]
+            self.pending = [last]
+            self.pendinglen = len(last)
+        else:
+            self.pending.append(last)
+            self.pendinglen += len(last)
+
+        if self.pendinglen > self.maxlen:  # split at the last whitespace, if any
+            i = max(last.rfind(" "), last.rfind("\t"))
+            if i >= 0:
+                self.pending[-1] = last[: i + 1]
+                lines.append("".join(self.pending))
+                self.pending = [last[i + 1 :]]
+                self.pendinglen = len(self.pending[0])
+
+        return lines
+
+    def close(self) -> List[str]:
+        "Return the last line, if there is one without a final newline."
+        if self.bytesdecoder is not None:
+            self.pending.append(self.bytesdecoder.decode(b"", final=True))
+        rest = "".join(self.pending)
+        self.pending = []
+        self.pendinglen = 0
+        return [rest + "\n"] if rest else []
+
+
+def iterchunklines(fp, chunksize=65536) -> Iterator[str]:
+    "Read file object *fp* *chunksize* at a time.  Yield each line (or piece)."
+    splitter = LineSplitter(chunksize)
+    while True:
+        chunk = fp.read(chunksize)
+        if not chunk:
+            break
+        yield from splitter.push(chunk)
+    yield from splitter.close()
+
+
+def toplevel(ret) -> list:
+    "Return the top-level values of decoded output *ret* as a list."
+    if isinstance(ret, list):
+        return ret
+    if ret is None:
+        return []
+    return [ret]  # top-level dict
+
+
+_PAUSE = object()  # yielded by _iterdecode when a push parse needs more input
+
+
+class _PushState:
+    "Input buffered by JdotDecoder.feed, and the suspended decode reading it."
+
+    def __init__(self, decoder, streaming=True):
+        self.splitter = LineSplitter()
+        self.lines = collections.deque()
+        self.closed = False
+        self.output = None  # return value of the decode, once finished
+        tokens = decoder.tokenize_regex(self.iterlines())
+        self.decoding = decoder._iterdecode(tokens, streaming=streaming)
 
-        if ch == delim:
-            return string, i
+    def push(self, data):
+        self.lines.extend(self.splitter.push(data))
 
-        elif ch == "\\":
-            string += ESCAPE_CHARS.get(s[i], s[i])  # next character, itself by default
-            i += 1
+    def close(self):
+        self.lines.extend(self.splitter.close())
+        self.closed = True
+
+    def iterlines(self):
+        "Yield each line fed so far, or None while waiting for more."
+        while True:
+            if self.lines:
+                yield self.lines.popleft()
+            elif self.closed:
+                return
+            else:
+                yield None
+
+    def run(self) -> list:
+        "Decode all the input available.  Return the top-level values completed."
+        values = []
+        try:
+            while True:
+                v = next(self.decoding)
+                if v is _PAUSE:
+                    return values
+                values.append(v)
+        except StopIteration as e:
+            self.output = e.value
+            values.extend(toplevel(e.value))
+            return values
+
+
+def _autoclose(it, frames):
+    "Yield Token from *it*, then a `)` for each macro invocation left open."
+    last = None
+    for t in it:
+        if t is not None:
+            last = t
+        yield t
+    while frames:
+        yield Token(")", ")", last.linenum, last.endcol, last.endcol + 1, last.line)
+
+
+class CompiledTemplate:
+    """A macro template compiled once into *build*, a function that returns a
+    new instance given a list with an arg for each of *slots* (the keys of
+    its Variables, in the order instantiate() takes them).  *build* is None
+    for templates nested too deeply to compile.  *stamp* is the version of
+    Macros at which the template was set, if known.  Pickles with its
+    generated code, but not its stamp, which only means something here."""
+
+    max_depth = 50
+
+    def __init__(self, template, stamp=None):
+        self.template = template
+        self.stamp = stamp
+        self.slots = []
+        self.build = None
+
+        if isinstance(template, Variable) and not template.key:
+            return  # nothing to instantiate; leave it to instantiate()
+
+        consts = {"InnerDict": InnerDict}
+        try:
+            source = self._source(template, consts, 0)
+        except RecursionError:
+            return
+        self.build = eval(f"lambda args: {source}", consts)
+
+    def __getstate__(self):
+        fstate = function_state(self.build) if self.build is not None else None
+        return (self.template, self.slots, fstate)
+
+    def __setstate__(self, state):
+        template, slots, fstate = state
+        build = restore_function(fstate) if fstate is not None else None
+        if build is None and fstate is not None:  # another version of Python
+            self.__init__(template)
         else:
-            string += ch
+            self.template = template
+            self.stamp = None
+            self.slots = slots
+            self.build = build
+
+    def is_current(self, template, stamp) -> bool:
+        """Whether this was compiled from *template* as set at version *stamp*
+        of Macros (if None, unknown: only the same template is current)."""
+        return template is self.template and stamp == self.stamp
+
+    def _source(self, v, consts, depth):
+        "Return a Python expression for *v*, with args[i] for each variable."
+        if depth > self.max_depth:
+            raise RecursionError("template too deep to compile")
+
+        if isinstance(v, dict):
+            items = ", ".join(
+                f"{repr(k)}: {self._source(x, consts, depth + 1)}"
+                for k, x in v.items()
+                if not _ignorable(x)
+            )
+            if isinstance(v, InnerDict):
+                return f"InnerDict({{{items}}})"
+            return f"{{{items}}}"
+        elif isinstance(v, list):
+            items = ", ".join(
+                self._source(x, consts, depth + 1) for x in v if not _ignorable(x)
+            )
+            return f"[{items}]"
+        elif isinstance(v, Variable):
+            self.slots.append(v.key)
+            return f"args[{len(self.slots) - 1}]"
+        elif type(v) in (str, int, bool, type(None)):
+            return repr(v)
+        else:
+            name = f"c{len(consts)}"
+            consts[name] = v
+            return name
+
 
-    return string, i  # not finished
+def _ignorable(obj):
+    return isinstance(obj, Variable) and not obj.key
 
 
 class DecodeException(Exception):
@@ -58,6 +405,101 @@ class JdotDecoder:
         raise DecodeException("\n".join(errmsgs))
 
     def tokenize(self, s: Union[str, Iterator[str]]) -> Iterator[Token]:
+        "*s* can be str or iterator of lines.  Return iterator of Token."
+        if self.options["tokenizer"] == "chars":
+            return self.tokenize_chars(s)
+        return self.tokenize_regex(s)
+
+    def tokenize_regex(self, s: Union[str, Iterator[str]]) -> Iterator[Token]:
+        """Tokenize a line at a time with _token_re.  Lines may also come in
+        pieces from LineSplitter.  A None line means no input yet, and is
+        passed on as a None token."""
+        finditer = _token_re.finditer
+        options = self.options
+        it = _iterlines(s)
+        linenum = 0
+        newline = True  # next line from *it* starts a new source line
+        incomment = False  # skipping a comment into the next piece
+
+        for line in it:
+            if line is None:  # waiting for more input
+                yield None
+                continue
+
+            if newline:
+                linenum += 1
+                if options["debug"]:
+                    self.debug(f"{linenum}: {line.strip()}")
+            newline = line[-1:] == "\n"
+
+            if incomment:
+                incomment = not newline
+                continue
+
+            pos = 0
+            while pos is not None:
+                for m in finditer(line, pos):
+                    comment, ch, tok, quoted, delim = m.groups()
+                    if comment:
+                        incomment = not newline
+                        break
+
+                    start, end = m.span()
+                    if ch:
+                        ttype, tok, kind = ch, ch, _fixed_kinds[ch]
+                    elif quoted is not None:
+                        tok += unescape(quoted[1:-1])
+                        ttype = "key" if tok[:1] == "." else "str"
+                        kind = _KEY if ttype == "key" else _STR
+                    elif delim:  # string continues onto the next lines
+                        break
+                    else:
+                        ttype = "token"
+                        kind = (
+                            _fixed_kinds.get(tok)
+                            or _prefix_kinds.get(tok[0])
+                            or _word_kind(tok)
+                        )
+                    yield Token(ttype, tok, linenum, start + 1, end + 1, line, kind)
+                else:
+                    pos = None
+                    continue
+
+                if comment:
+                    break
+
+                startline = linenum
+                pos = m.end()
+                bits = [tok]  # joined once the string is done
+                while True:
+                    bit, pos = parse_escaped_str(line, i=pos, delim=delim)
+                    bits.append(bit)
+                    if pos < len(line):  # string done before end of line
+                        break
+
+                    if newline:
+                        linenum += 1
+                    pos = 0
+                    try:
+                        line = next(it)
+                        while line is None:  # waiting for more input
+                            yield None
+                            line = next(it)
+                    except StopIteration:
+                        self.error(f"unterminated string: {repr(''.join(bits))}")
+                    newline = line[-1:] == "\n"
+
+                tok = "".join(bits)
+                ttype = "key" if tok[:1] == "." else "str"
+                if startline == linenum:
+                    yield Token(ttype, tok, linenum, start + 1, pos + 1, line)
+                else:
+                    yield MultilineToken(
+                        ttype, tok, startline, start + 1, linenum, pos + 1, line
+                    )
+
+    def tokenize_chars(self, s: Union[str, Iterator[str]]) -> Iterator[Token]:
+        "Tokenize a character at a time (the original tokenizer)."
         startchnum = 1
         tok = ""
 
@@ -65,15 +507,13 @@ class JdotDecoder:
         linenum = 0
         line = ""
 
-        if isinstance(s, str):
-            it = iter(x + "\n" for x in s.splitlines())
-        else:
-            it = iter(s)
+        it = _iterlines(s)
 
         while True:
             if not line[chnum - 1 :]:
                 linenum += 1
                 chnum = 1
+                startchnum = 1
                 try:
                     line = next(it)
                 except StopIteration:
@@ -91,10 +531,8 @@ class JdotDecoder:
                 continue
 
             if ch.isspace() or ch in "{}[]()<>":
-                if tok:
-                    yield Token(
-                        "token", tok, (linenum, startchnum), (linenum, chnum), line
-                    )
+                if tok:  # ends before *ch*
+                    yield Token("token", tok, linenum, startchnum, chnum - 1, line)
                     tok = ""
                 startchnum = chnum
 
@@ -104,9 +542,10 @@ class JdotDecoder:
             if ch in "\"'":
                 startline = linenum
 
+                bits = [tok]
                 while True:
                     bit, i = parse_escaped_str(line, i=chnum - 1, delim=ch)
-                    tok += bit
+                    bits.append(bit)
                     if i < len(line):  # string done before end of string
                         chnum = i + 1
                         break
@@ -116,16 +555,16 @@ class JdotDecoder:
                         try:
                             line = next(it)
                         except StopIteration:
-                            self.error(f"unterminated string: {repr(tok)}")
+                            self.error(f"unterminated string: {repr(''.join(bits))}")
                             break
 
-                if tok[:1] == ".":
-                    yield Token(
-                        "key", tok, (startline, startchnum), (linenum, chnum), line
-                    )
+                tok = "".join(bits)
+                ttype = "key" if tok[:1] == "." else "str"
+                if startline == linenum:
+                    yield Token(ttype, tok, linenum, startchnum, chnum, line)
                 else:
-                    yield Token(
-                        "str", tok, (startline, startchnum), (linenum, chnum), line
+                    yield MultilineToken(
+                        ttype, tok, startline, startchnum, linenum, chnum, line
                     )
 
                 tok = ""
@@ -133,69 +572,136 @@ class JdotDecoder:
                 continue
 
             if ch in "{}[]()<>":
-                yield Token(ch, ch, (linenum, chnum - 1), (linenum, chnum), line)
+                yield Token(ch, ch, linenum, chnum - 1, chnum, line)
             else:
                 tok += ch
 
         if tok:
-            yield Token(tok, tok, (linenum, chnum - 1), (linenum, chnum), line)
+            yield Token(tok, tok, linenum, chnum - 1, chnum, line)
             tok = ""
 
     def decode(self, s):
+        cache = self.decode_cache
+        if cache is not None and isinstance(s, str):
+            return cache.decode(self, s)
         return self.iterdecode(self.tokenize(s))
 
     def iterdecode(self, it):
-        "*it* can be str or generator of Token.  Return list of parsed objects."
+        "*it* is an iterator of Token.  Return the parsed output (list or dict)."
+        try:
+            next(self._iterdecode(it))  # never yields when not streaming
+        except StopIteration as e:
+            return e.value
+
+    def iterdecode_objects(self, fp, chunksize=65536):
+        """Decode jdot read from file object *fp*, *chunksize* characters at a
+        time.  Yield each top-level value as soon as it is complete."""
+        ret = yield from self._iterdecode(
+            self.tokenize(iterchunklines(fp, chunksize)), streaming=True
+        )
+        yield from toplevel(ret)  # anything left open at the end of input
+
+    def feed(self, data: Union[str, bytes]) -> list:
+        """Push-parse another chunk of input (str, or utf-8 bytes).  Return the
+        top-level values completed by whole lines received so far.  Decoding
+        state is kept between calls; call close() after the last chunk."""
+        if self._pushstate is None:
+            self._pushstate = _PushState(self)
+        state = self._pushstate
+        state.push(data)
+        try:
+            return state.run()
+        except Exception:
+            self._pushstate = None
+            raise
+
+    def close(self) -> list:
+        "Finish a push parse.  Return the top-level values not yet returned."
+        state, self._pushstate = self._pushstate, None
+        if state is None:
+            return []
+        state.close()
+        return state.run()
+
+    async def adecode(self, reader, chunksize=65536):
+        """Decode jdot read from asyncio.StreamReader *reader* as it arrives,
+        letting other tasks run after each chunk.  Return the parsed output."""
+        state = _PushState(self, streaming=False)
+        while True:
+            data = await reader.read(chunksize)
+            if not data:
+                break
+            state.push(data)
+            state.run()
+            await asyncio.sleep(0)
+        state.close()
+        state.run()
+        return state.output
+
+    def _iterdecode(self, it, streaming=False):
+        """Generator that decodes Token from *it* and returns the output.
+        If *streaming*, each item of the top-level list is yielded (and
+        removed from the output) once it is complete."""
 
         key = None
         ret = None  # root list to return
         stack = []  # path from root
         curr = None
+        frames = []  # (name, key, ret, stack, curr) for each open macro invocation
+        cached = True  # use compiled_macros
+        options = self.options
         self.globals["output"] = None  # make available as '@output'
 
-        while True:
-            try:
-                self.toktuple = next(it)
-            except StopIteration:
-                break
+        it = _autoclose(it, frames)  # names are read from it too, to place its `)`
+        for self.toktuple in it:
+            if self.toktuple is None:  # push parse waiting for more input
+                yield _PAUSE
+                continue
 
             out = None  # value to set at current key or append to list
             append_stack = False  # append curr to stack after setting key value
             tok = self.toktuple.string
+            kind = self.toktuple.kind
 
-            self.debug(stack, curr, self.toktuple)
+            if options["debug"]:
+                self.debug(stack, curr, self.toktuple)
 
-            if self.toktuple.type == "str":  # string literal
+            if kind is _STR:  # string literal
                 out = tok
 
-            elif tok[0] == "?":  # variable
+            elif kind is _VARIABLE:
                 out = Variable(tok[1:])
 
-            elif tok[0] == "@":  # global variable like '@options' and '@macros'
+            elif kind is _GLOBAL:  # global variable like '@options' and '@macros'
                 name = tok[1:]
                 if name not in self.globals:
                     self.error(f"no such global {name}")
 
                 self.debug(f"global {tok}")
                 curr = self.globals[name]
-                stack = [curr]
+                if curr is self.macros and self.frozen is not None:
+                    self.unshare_macros()
+                stack = [curr] if curr is not None else []
                 self.restart()
+                cached = curr is not self.macros  # templates may change in @macros
                 continue
 
             elif tok in self.macros:  # bare macro, instantiate without args
-                out = self.instantiate(self.macros[tok], [], tok)
+                out = self.instantiate_macro(tok, [], cached)
 
-            elif tok == "!":  # show debugging info
-                print("macros", self.macros)
-                print("options", self.options)
-                print("stack", stack)
-                continue
+            elif kind is _INT:
+                out = int(tok)
 
-            elif tok[0] == ".":  # dict key
+            elif kind is _FLOAT:
+                out = float(tok)
+
+            elif kind is _KEY:  # dict key
                 if curr is None:
-                    assert not self.globals["output"]
-                    ret = curr = self.globals["output"] = dict()
+                    assert not stack
+                    ret = curr = dict()
                     stack.append(curr)
+                    if not frames:
+                        self.globals["output"] = ret
 
                 if isinstance(curr, list):
                     r = dict()  # open new dict by default
@@ -212,81 +718,91 @@ class JdotDecoder:
                 key = tok[1:]
                 continue
 
-            elif tok == "{":  # open dict outer
-                out = dict()
-                append_stack = True
+            elif kind is _KEYWORD:  # true, false or null
+                out = _KEYWORDS[tok]
 
-            elif tok == "<":  # open dict inner
-                out = InnerDict()
+            elif kind is _OPEN:  # open dict outer, dict inner or list
+                out = _OPENERS[tok]()
                 append_stack = True
 
-            elif tok == "[":  # open list
-                out = list()
-                append_stack = True
+            elif kind is _CLOSE:
+                if tok == "}":  # close dict outer
+                    if not isinstance(curr, dict):
+                        self.error("mismatched closing }")
+                    stack.pop()
 
-            elif tok == "}":  # close dict outer
-                if not isinstance(curr, dict):
-                    self.error("mismatched closing }")
-                stack.pop()
-                curr = stack[-1] if stack else None
-                continue
+                elif tok == "]":  # close list
+                    stack.pop()
+                    if not isinstance(curr, list) and not isinstance(stack[-1], list):
+                        self.error("mismatched closing ]")
+
+                else:  # close dict inner
+                    if not isinstance(curr, InnerDict):
+                        self.error("mismatched closing >")
+                    stack.pop()
 
-            elif tok == "]":  # close list
-                stack.pop()
-                if not isinstance(curr, list) and not isinstance(stack[-1], list):
-                    self.error("mismatched closing ]")
                 curr = stack[-1] if stack else None
+                if streaming and curr is ret and isinstance(ret, list) and not frames:
+                    yield from ret
+                    ret.clear()
                 continue
 
-            elif tok == ">":  # close dict inner
-                if not isinstance(curr, InnerDict):
-                    self.error("mismatched closing >")
-                stack.pop()
-                curr = stack[-1] if stack else None
+            elif kind is _MACRO_OPEN:  # decode its args into a new frame
+                t = next(it, "")
+                while t is None:  # push parse waiting for more input
+                    yield _PAUSE
+                    t = next(it, "")
+                if not t:
+                    self.error("missing macro name")
+                frames.append((t.string, key, ret, stack, curr))
+                key = ret = curr = None
+                stack = []
                 continue
 
-            elif tok == "(":  # open macro, instantiate with args
-                name = next(it).string
-                args = self.iterdecode(it)  # recurse
+            elif kind is _MACRO_CLOSE:  # end macro arguments, instantiate with args
+                if not frames:
+                    self.error("mismatched closing )")
+                args = ret
+                name, key, ret, stack, curr = frames.pop()
                 if name not in self.macros:
                     self.error(f'no macro named "{name}"')
 
-                out = self.instantiate(self.macros[name], args, name)  # mutates args
+                out = self.instantiate_macro(name, args, cached)  # mutates args
                 if args:  # none should be left over
                     self.error(
                         f'too many args given to "{name}" {args}: {self.macros[name]}'
                     )
 
-            elif tok == ")":  # end macro arguments
-                break  # exit recurse
-
-            elif tok == "true":
-                out = True
-            elif tok == "false":
-                out = False
-            elif tok == "null":
-                out = None
+            elif kind is _DEBUG:  # show debugging info
+                print("macros", self.macros)
+                print("options", self.options)
+                print("stack", stack)
+                continue
 
             else:
-                # try parsing as number
-                try:
-                    out = int(tok)
-                except ValueError:
+                out = None
+                if _maybe_number_re.match(tok):  # try parsing as number
                     try:
-                        out = float(tok)
+                        out = int(tok)
                     except ValueError:
-                        if self.options["strict"]:
-                            self.error(f"unknown token '{out}' (strict mode)")
-                        out = tok  # pass it through as a string to be nice
+                        try:
+                            out = float(tok)
+                        except ValueError:
+                            pass
+                if out is None:
+                    if self.options["strict"]:
+                        self.error(f"unknown token '{out}' (strict mode)")
+                    out = tok  # pass it through as a string to be nice
 
             # add 'out' to the top object
 
             if curr is None:
                 assert ret is None
                 assert not stack
-                assert not self.globals["output"]
-                ret = curr = self.globals["output"] = list()
+                ret = curr = list()
                 stack.append(curr)
+                if not frames:
+                    self.globals["output"] = ret
 
             if isinstance(curr, dict):
                 if key is None:
@@ -324,36 +840,91 @@ class JdotDecoder:
                 stack.append(out)
                 curr = out
 
+            elif streaming and curr is ret and isinstance(ret, list) and not frames:
+                yield from ret
+                ret.clear()
+
         return ret
 
-    def instantiate(self, v, args, tmplname):
-        """"""
-
-        def ignorable(obj):
-            return isinstance(obj, Variable) and not obj.key
-
-        if isinstance(v, InnerDict):
-            return InnerDict(
-                {
-                    k: self.instantiate(x, args, tmplname)
-                    for k, x in v.items()
-                    if not ignorable(x)
-                }
-            )
-        elif isinstance(v, dict):
-            return {
-                k: self.instantiate(x, args, tmplname)
-                for k, x in v.items()
-                if not ignorable(x)
-            }
-        elif isinstance(v, list):
-            return list(
-                self.instantiate(x, args, tmplname) for x in v if not ignorable(x)
+    def unshare_macros(self):
+        """Replace the templates shared with self.frozen by private copies, so
+        that decoding `@macros` can change them."""
+        self.macros.update(copy.deepcopy(self.macros))
+        self.frozen = None
+
+    def instantiate_macro(self, name, args, cached=True):
+        """Return a new instance of macro *name*, taking its args from the front
+        of list *args* like instantiate(), but with its CompiledTemplate.  If
+        *cached*, reuse the CompiledTemplate in compiled_macros until the macro
+        is set again; otherwise (as while templates are being defined) just
+        call instantiate()."""
+        template = self.macros[name]
+        if not cached:
+            return self.instantiate(template, [] if args is None else args, name)
+
+        stamp = self.macros.stamps.get(name)
+        compiled = self.compiled_macros.get(name)
+        if compiled is None or not compiled.is_current(template, stamp):
+            if self.frozen is not None:
+                compiled = self.frozen.compiled_macros.get(name)
+            if compiled is None or not compiled.is_current(template, stamp):
+                compiled = CompiledTemplate(template, stamp)
+                self.compiled_macros[name] = compiled
+
+        if args is None:
+            args = []
+        if compiled.build is None or not isinstance(args, list):
+            return self.instantiate(template, args, name)
+
+        n = len(compiled.slots)
+        if len(args) < n:
+            self.error(
+                f'missing arg "{compiled.slots[len(args)]}" for template "{name}"'
             )
-        elif isinstance(v, Variable):
-            assert not ignorable(v)
-            if not args:
-                self.error(f'missing arg "{v.key}" for template "{tmplname}"')
-            return args.pop(0)
-        else:
-            return v
+        ret = compiled.build(args)
+        del args[:n]
+        return ret
+
+    def instantiate(self, v, args, tmplname):
+        """Return a new instance of template *v*, popping an arg from the front
+        of list *args* for each Variable, in order."""
+        assert not _ignorable(v)
+
+        ret = []
+        # (items of template container left to instantiate, new container)
+        stack = [(iter([(None, v)]), ret)]
+        while stack:
+            items, dest = stack[-1]
+            for k, x in items:
+                if _ignorable(x):
+                    continue
+
+                inner = None
+                if isinstance(x, InnerDict):
+                    new = InnerDict()
+                    inner = iter(x.items())
+                elif isinstance(x, dict):
+                    new = {}
+                    inner = iter(x.items())
+                elif isinstance(x, list):
+                    new = []
+                    inner = ((None, y) for y in x)
+                elif isinstance(x, Variable):
+                    if not args:
+                        self.error(f'missing arg "{x.key}" for template "{tmplname}"')
+                    new = args.pop(0)
+                else:
+                    new = x
+
+                if isinstance(dest, list):
+                    dest.append(new)
+                else:
+                    dest[k] = new
+
+                if inner is not None:
+                    stack.append((inner, new))
+                    break
+            else:
+                stack.pop()
+
+        return ret[0]
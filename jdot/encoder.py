@@ -1,121 +1,397 @@
 # SPDX-License-Identifier: Apache-2.0
 
-from .jdot import InnerDict, deep_match, deep_del, deep_len
+import os
+import re
+import asyncio
+import functools
+import itertools
+import collections
+import concurrent.futures
+
+from .jdot import InnerDict, Variable, deep_del, deep_len
 from .formatter import JdotFormatter
+from .macroindex import MacroIndex
+from . import snapshot
+
+# iterencode() stack operations
+_VALUE = "value"  # encode a value
+_TOKEN = "token"  # emit a token
+_INNARDS = "innards"  # emit the tokens of a finished macro invocation
+_MATCH = "match"  # find the next macro matching a dict, or else emit it
+_INVOKED = "invoked"  # finish a macro invocation once its args are encoded
+
+
+_needs_escape_re = re.compile(r"[\\\"']")
+_needs_quotes_re = re.compile(r"[ .{}<>\[\]()]")  # keys that must be quoted
+_escapes = {
+    delim: str.maketrans({"\\": "\\\\", delim: "\\" + delim}) for delim in "\"'"
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def _literal_str(obj):
+    "The literal for non-empty string *obj*."
+    if not _needs_escape_re.search(obj):
+        return f'"{obj}"'
+    delim = "'" if obj.count('"') > obj.count("'") else '"'
+    return delim + obj.translate(_escapes[delim]) + delim
+
+
+def _scalar_key(v):
+    """The key of scalar *v* among the scalar macros of its type, so that only
+    values written the same are taken for each other: not 0.0 and -0.0."""
+    return v.hex() if type(v) is float else v
+
+
+def _iterchunks(pieces, chunksize, sep=""):
+    "Yield sep.join(pieces) about *chunksize* characters at a time."
+    prefix = ""
+    chunk = []
+    size = 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece) + len(sep)
+        if size >= chunksize:
+            yield prefix + sep.join(chunk)
+            prefix = sep
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield prefix + sep.join(chunk)
+
+
+def _flatten(innards):
+    "Yield the tokens of a macro invocation, including nested invocations."
+    stack = [iter(innards)]
+    while stack:
+        for tok in stack[-1]:
+            if isinstance(tok, list):
+                stack.append(iter(tok))
+                break
+            yield tok
+        else:
+            stack.pop()
+
+
+_worker = None  # the coder of an encode_parallel() worker process
+
+
+def _init_worker(data):
+    global _worker
+    _worker = snapshot.loads(data)
+
+
+def _encode_chunk(args):
+    "Encode a chunk of top-level items in a worker, as a string or tokens."
+    chunk, sort_key, join = args
+    tokens = _worker.iterencode(chunk, _worker._get_sort_key(sort_key))
+    return " ".join(tokens) if join else list(tokens)
+
+
+MatchMemoInfo = collections.namedtuple("MatchMemoInfo", "hits misses maxsize currsize")
+
+
+class _MatchMemo:
+    """The macros that matched each dict during one iterencode(), with their
+    bindings and what was left of the dict, to be replayed for dicts with the
+    same contents.  Keeps the *maxsize* most recently used.
+
+    Each dict and list is given a structure id, the same for any with equal
+    contents (in the same order, and with values of the same types), found
+    bottom up so that no key is hashed more than once.  The ids found for
+    the dicts and lists inside a dict are kept until the encoder gets to
+    each of them (see done()), and the *structures_per_plan* * *maxsize*
+    structures seen last are kept, dropping the oldest, so that equal dicts
+    seen again soon get the same id."""
+
+    structures_per_plan = 4
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.plans = collections.OrderedDict()  # structure id -> (matches, rest)
+        self.ids = {}  # id(obj) -> (obj, structure id or None if unhashable)
+        self.structures = collections.OrderedDict()  # (type, contents) -> id
+        self.nstructures = 0  # structure ids given out, never reused
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, obj):
+        """Return the structure id of *obj*, or None if it holds unhashable
+        values.  Once per dict, as the encoder gets to it."""
+        ids = self.ids
+        entry = ids.pop(id(obj), None)  # found with the dict it is in
+        if entry is not None:
+            return entry[1]
+
+        structures = self.structures
+        stack = [obj]
+        while stack:
+            x = stack[-1]
+            values = x.values() if isinstance(x, dict) else x
+            contents = []
+            for v in values:
+                if isinstance(v, (dict, list)):
+                    entry = ids.get(id(v))
+                    if entry is None:  # key the children first
+                        stack.append(v)
+                        contents = None
+                    elif contents is not None:
+                        contents.append(entry[1])  # None if unhashable
+                elif contents is not None:
+                    if type(v) is float:  # so that 0.0 and -0.0 differ
+                        contents.append((float, v.hex()))
+                    else:
+                        contents.append((type(v), v))
+            if contents is None:
+                continue
+
+            stack.pop()
+            if isinstance(x, dict):
+                contents = (dict, tuple(x), tuple(contents))
+            else:
+                contents = (list, tuple(contents))
+            try:
+                if None in contents[-1]:  # a child with unhashable values
+                    raise TypeError
+                key = structures.setdefault(contents, self.nstructures)
+            except TypeError:  # an unhashable value
+                key = None
+            else:
+                if key == self.nstructures:  # new
+                    self.nstructures += 1
+                    if len(structures) > self.structures_per_plan * self.maxsize:
+                        structures.popitem(last=False)
+            ids[id(x)] = (x, key)  # keep *x*, so its id is not reused
+
+        return ids.pop(id(obj))[1]
+
+    def done(self, obj):
+        "Forget the structure id of list *obj*, which the encoder has got to."
+        self.ids.pop(id(obj), None)
+
+    def get(self, key):
+        "Return the (matches, rest) recorded for *key*, or None."
+        plan = self.plans.get(key)
+        if plan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.plans.move_to_end(key)
+        return plan
+
+    def put(self, key, matches, rest):
+        self.plans[key] = (matches, rest)
+        if len(self.plans) > self.maxsize:
+            self.plans.popitem(last=False)
+
+    def info(self):
+        return MatchMemoInfo(self.hits, self.misses, self.maxsize, len(self.plans))
+
+
+class _DictState:
+    "A dict being encoded by iterencode(), and the macros matched so far."
+
+    __slots__ = (
+        "obj",
+        "copied",
+        "start",
+        "macro_invocations",
+        "key",
+        "matches",
+        "replay",
+        "rest",
+    )
+
+    def __init__(self, obj):
+        self.obj = obj  # what is left to match
+        self.copied = False  # whether *obj* is a copy that can be changed
+        self.start = 0  # index of the next macro to try
+        self.macro_invocations = []
+        self.key = None  # structure id in the _MatchMemo, if recording
+        self.matches = None  # matches recorded so far
+        self.replay = None  # iterator of the matches recorded for an equal dict
+        self.rest = None  # what was left of that dict
 
 
 class JdotEncoder:
     def __init__(self):
         self.revmacros = {}
+        self.macroindex = None
+        self.frozen = None  # FrozenMacros, if shared
+        self.match_memo_info = None  # MatchMemoInfo of the last iterencode()
 
     def restart(self):
-        self.revmacros = {
-            v: k for k, v in self.macros.items() if not isinstance(v, (dict, list))
-        }
+        self.index_scalar_macros()
+        self.macroindex = None  # rebuilt when next encoding
 
-    def iterencode(self, obj, sort_key=lambda x: 0, depth=0, parents=None):
-        """"""
-        if parents is None:
-            parents = []
-
-        if isinstance(obj, dict):
-            if not obj:
-                yield "{}"
-                return
+    def index_scalar_macros(self):
+        """Index the scalar macros in revmacros, by the type and then
+        _scalar_key() of their value, so that 1, 1.0 and true are not taken
+        for each other.  Empty if there are none."""
+        self.revmacros = {}
+        for k, v in self.macros.items():
+            if not isinstance(v, (dict, list, Variable)):
+                self.revmacros.setdefault(type(v), {})[_scalar_key(v)] = k
 
-            # emit first macro, if any match
-            macro_invocations = []
-            macros_remaining = list(self.macros.items())
-            copied = False
-            while macros_remaining:
-                macroname, macro = macros_remaining[0]
-                m = deep_match(obj, macro)
-                if m is False:  # didn't match
-                    macros_remaining.pop(0)
+    def iterencode(self, obj, sort_key=lambda x: 0, depth=0, parents=None):
+        """Yield the tokens encoding *obj*.  Works from an explicit stack rather
+        than recursing, so nesting depth is not limited by the interpreter.
+        *parents* is unused, and kept for compatibility."""
+        if depth == 0:  # macros may have been changed directly
+            if self.macroindex is None or not self.macroindex.is_current(self.macros):
+                frozen = self.frozen
+                if frozen is not None and frozen.macroindex.is_current(self.macros):
+                    self.macroindex = frozen.macroindex
+                else:
+                    self.macroindex = MacroIndex(self.macros)
+                self.index_scalar_macros()
+
+        memo = None
+        if depth == 0 and self.options.get("match_memo"):
+            memo = _MatchMemo(self.options["match_memo"])
+
+        revmacros = self.revmacros  # empty unless there are scalar macros
+        stack = [(_VALUE, obj, depth)]
+        invocations = []  # macro invocations whose args are being encoded
+
+        while stack:
+            op, obj, depth = stack.pop()
+
+            if op is _TOKEN:
+                tok = obj
+
+            elif op is _INNARDS:
+                if invocations:  # nest it as is, already stripped
+                    invocations[-1].append(obj)
+                else:
+                    yield from _flatten(obj)
+                continue
+
+            elif op is _VALUE:
+                if isinstance(obj, dict):
+                    if not obj:
+                        tok = "{}"
+                    else:
+                        state = _DictState(obj)
+                        if memo is not None:
+                            key = memo.key(obj)
+                            plan = memo.get(key) if key is not None else None
+                            if plan is not None:
+                                state.replay = iter(plan[0])
+                                state.rest = plan[1]
+                            elif key is not None:
+                                state.key = key
+                                state.matches = []
+                        stack.append((_MATCH, state, depth))
+                        continue
+
+                elif isinstance(obj, (list, tuple)):
+                    if memo is not None:
+                        memo.done(obj)
+                    if obj and depth > 0:
+                        stack.append((_TOKEN, "]", depth))
+                    for v in reversed(obj):
+                        stack.append((_VALUE, v, depth + 1))
+                    if not obj:
+                        stack.append((_TOKEN, "]", depth))
+                    if not obj or depth > 0:
+                        stack.append((_TOKEN, "[", depth))
                     continue
 
-                if isinstance(m, dict):  # matched with args
-                    if m:
-                        macro_invocation = ["(", macroname]
-                        args = [
-                            self.iterencode(x, sort_key, depth=depth + 1)
-                            for x in m.values()
-                        ]
-                        macro_invocation.extend(
-                            x.strip() for y in args for x in y if x.strip()
-                        )
-                        macro_invocation.append(")")
+                else:
+                    names = revmacros.get(type(obj)) if revmacros else None
+                    if names is not None:
+                        tok = names.get(_scalar_key(obj)) or self.literal(obj)
                     else:
-                        macro_invocation = [macroname]
-
-                    macro_invocations.append(macro_invocation)
-
-                    if isinstance(macro, InnerDict):
-                        if not copied:
-                            obj = obj.copy()
-                            copied = True
-                        deep_del(obj, macro)
+                        tok = self.literal(obj)
+
+            elif op is _MATCH:  # emit first macro, if any match
+                state = obj
+                obj = state.obj
+                match = None
+                if state.replay is not None:  # as matched for an equal dict
+                    match = next(state.replay, None)
+                    if match is None:
+                        obj = state.obj = state.rest
+                elif obj:
+                    match = next(self.macroindex.matches(obj, state.start), None)
+                    if state.matches is not None and match is not None:
+                        state.matches.append(match)
+
+                if match is not None:
+                    state.start, macroname, macro, m = match
+                    if m:  # matched with args
+                        invocations.append(["(", macroname])
                     else:
-                        obj = {}
-
-                    if not obj:
-                        break
-
-            show_braces = (depth != 0) and (len(macro_invocations) + len(obj) > 1)
-
-            if show_braces:
-                yield "{"
-
-            for innards in macro_invocations:
-                yield from innards
-
-            for k, v in sorted(obj.items(), key=sort_key):
-                if any(x in k for x in " .{}<>[]()"):
-                    k = self.literal(k)
-                yield f".{k}"
-                yield from self.iterencode(
-                    v, sort_key, depth=depth + 1, parents=parents + [obj]
-                )
-
-            if show_braces:
-                yield "}"
-
-        elif isinstance(obj, (list, tuple)):
-            if not obj:
-                yield "["
-                yield "]"
-                return
-
-            if depth > 0:
-                yield "["
-
-            for v in obj:
-                yield from self.iterencode(
-                    v, sort_key, depth=depth + 1, parents=parents + [obj]
-                )
+                        invocations.append([macroname])
+                    stack.append((_INVOKED, (state, macro, bool(m)), depth))
+                    for x in reversed(list(m.values())):
+                        stack.append((_VALUE, x, depth + 1))
+                    continue
 
-            if depth > 0:
-                yield "]"
-
-        elif obj in self.revmacros:
-            yield self.revmacros[obj]
-        else:
-            yield self.literal(obj)
+                if state.matches is not None:
+                    memo.put(state.key, state.matches, obj)
+
+                macro_invocations = state.macro_invocations
+                show_braces = (depth != 0) and (len(macro_invocations) + len(obj) > 1)
+
+                if show_braces:
+                    stack.append((_TOKEN, "}", depth))
+
+                for k, v in reversed(sorted(obj.items(), key=sort_key)):
+                    stack.append((_VALUE, v, depth + 1))
+                    if _needs_quotes_re.search(k):
+                        k = self.literal(k)
+                    stack.append((_TOKEN, f".{k}", depth))
+
+                for innards in reversed(macro_invocations):
+                    stack.append((_INNARDS, innards, depth))
+
+                if show_braces:
+                    stack.append((_TOKEN, "{", depth))
+                continue
+
+            else:  # _INVOKED: all args of a macro invocation are encoded
+                state, macro, has_args = obj
+                macro_invocation = invocations.pop()
+                if has_args:
+                    macro_invocation.append(")")
+                state.macro_invocations.append(macro_invocation)
+
+                if state.replay is not None:  # what is left is known already
+                    pass
+                elif isinstance(macro, InnerDict):
+                    if not state.copied:
+                        state.obj = state.obj.copy()
+                        state.copied = True
+                    # the dicts inside belong to the caller, so copy those too
+                    deep_del(state.obj, macro, copy_inner=True)
+                    # fewer keys may let other macros match; retry from this one
+                else:
+                    state.obj = {}
+
+                stack.append((_MATCH, state, depth))
+                continue
+
+            if invocations:  # part of a macro arg
+                tok = tok.strip()
+                if tok:
+                    invocations[-1].append(tok)
+            else:
+                yield tok
+
+        if memo is not None:
+            self.match_memo_info = memo.info()
+            self.debug(f"match memo: {self.match_memo_info}")
 
     def literal(self, obj):
         if isinstance(obj, str):
             if not obj:
                 return '""'
-
-            delim = "'" if obj.count('"') > obj.count("'") else '"'
-
-            r = ""
-            for ch in obj:
-                if ch in ["\\", delim]:
-                    r += "\\"
-                r += ch
-
-            return delim + r + delim
+            if len(obj) > 100:  # not worth keeping in the cache
+                return _literal_str.__wrapped__(obj)
+            return _literal_str(obj)
 
         elif obj is True:
             return "true"
@@ -141,6 +417,15 @@ class JdotEncoder:
     def _sort_by_size(x):
         return deep_len(x[1])
 
+    def _get_sort_key(self, sort_key):
+        if sort_key is None:
+            return self._sort_as_is
+        elif sort_key == "key":
+            return self._sort_by_key
+        elif sort_key == "size":
+            return self._sort_by_size
+        return sort_key
+
     def encode(self, obj, formatter=None, sort_key=None):
         """Encodes the given object as JDOT using the macros currently
         registered with this encoder.
@@ -160,10 +445,69 @@ class JdotEncoder:
             formatter = " ".join
         elif formatter == "pretty":
             formatter = JdotFormatter()
-        if sort_key is None:
-            sort_key = self._sort_as_is
-        elif sort_key == "key":
-            sort_key = self._sort_by_key
-        elif sort_key == "size":
-            sort_key = self._sort_by_size
-        return formatter(self.iterencode(obj, sort_key))
+        return formatter(self.iterencode(obj, self._get_sort_key(sort_key)))
+
+    def encode_parallel(
+        self, objs, workers=None, formatter=None, sort_key=None, chunksize=None
+    ):
+        """Encode list *objs* as encode() would, with its top-level items
+        encoded *chunksize* at a time in *workers* processes (by default, one
+        for each CPU).  The macros are sent to each worker once, as a snapshot.
+        The output is the same as from encode(); unless *formatter* is None,
+        it formats all the tokens in this process.  *sort_key* has to be
+        picklable."""
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if not isinstance(objs, list) or workers <= 1 or len(objs) < 2:
+            return self.encode(objs, formatter, sort_key)
+
+        if chunksize is None:  # a few chunks per worker, to even out the load
+            chunksize = -(-len(objs) // (workers * 4))
+        join = formatter is None or formatter == " ".join
+        chunks = [
+            (objs[i : i + chunksize], sort_key, join)
+            for i in range(0, len(objs), chunksize)
+        ]
+
+        data = snapshot.dumps(self, precompile=False)
+        with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(data,)
+        ) as pool:
+            results = list(pool.map(_encode_chunk, chunks))
+
+        if join:
+            return " ".join(results)
+        if formatter == "pretty":
+            formatter = JdotFormatter()
+        return formatter(itertools.chain.from_iterable(results))
+
+    async def aencode(self, obj, writer, sort_key=None, chunksize=65536):
+        """Encode *obj* as by encode_oneliner() to asyncio.StreamWriter *writer*,
+        writing utf-8 about *chunksize* characters at a time and waiting for
+        the writer to drain after each chunk."""
+        tokens = self.iterencode(obj, self._get_sort_key(sort_key))
+        for chunk in _iterchunks(tokens, chunksize, " "):
+            writer.write(chunk.encode("utf-8"))
+            await writer.drain()
+            await asyncio.sleep(0)
+        await writer.drain()
+
+    def dump(self, obj, fp, formatter=None, sort_key=None, chunksize=65536):
+        """Encode *obj* as by encode(), writing the output to text file *fp*
+        about *chunksize* characters at a time rather than building it as one
+        string.  The output is streamed if *formatter* is None, 'pretty', or
+        has an iterformat() method like JdotFormatter; any other formatter is
+        given all the tokens and its result written at once."""
+        tokens = self.iterencode(obj, self._get_sort_key(sort_key))
+        if formatter is None:
+            pieces = _iterchunks(tokens, chunksize, " ")
+        else:
+            if formatter == "pretty":
+                formatter = JdotFormatter()
+            if not hasattr(formatter, "iterformat"):
+                fp.write(formatter(tokens))
+                return
+            pieces = _iterchunks(formatter.iterformat(tokens), chunksize)
+
+        for chunk in pieces:
+            fp.write(chunk)
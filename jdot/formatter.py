@@ -1,6 +1,15 @@
 # SPDX-License-Identifier: Apache-2.0
 
-__all__ = ["JdotFormatter"]
+import itertools
+import collections
+
+__all__ = ["JdotFormatter", "JdotStreamFormatter"]
+
+
+class _Tokens(list):
+    "A nested token list, measured by JdotFormatter._measure()."
+
+    __slots__ = ("items", "values", "nested", "width", "special")
 
 
 class JdotFormatter:
@@ -42,15 +51,18 @@ class JdotFormatter:
         self._close_on_same_line = close_on_same_line
         self._dedent_last_value = dedent_last_value
 
-    @staticmethod
-    def _is_open(token):
+    _opens = frozenset("({[<")
+    _closes = frozenset(")}]>")
+
+    @classmethod
+    def _is_open(cls, token):
         """Whether a token is some kind of open-parenthesis."""
-        return isinstance(token, str) and token in set("({[<")
+        return isinstance(token, str) and token in cls._opens
 
-    @staticmethod
-    def _is_close(token):
+    @classmethod
+    def _is_close(cls, token):
         """Whether a token is some kind of close-parenthesis."""
-        return isinstance(token, str) and token in set(")}]>")
+        return isinstance(token, str) and token in cls._closes
 
     @staticmethod
     def _is_key(token):
@@ -85,6 +97,12 @@ class JdotFormatter:
 
     @classmethod
     def _preprocess(cls, tokens) -> list:
+        """Preprocess the given iterable of tokens into nested lists, as
+        described for _iterpreprocess()."""
+        return cls._measure(_Tokens(cls._iterpreprocess(tokens)))
+
+    @classmethod
+    def _iterpreprocess(cls, tokens):
         """
         Preprocess the given iterable of tokens:
          - Combine parenthesized groups of tokens into nested lists, such
@@ -94,9 +112,9 @@ class JdotFormatter:
            value token later on).
          - Remove any pre-existing whitespace (there probably won't be any if
            this is run on the output of the encoder).
+        Yields each top-level token or nested list once it is complete.
         """
-        root = []
-        stack = [root]
+        stack = [None]  # the root list is never built
         for token in tokens:
 
             # Strip whitespace.
@@ -106,24 +124,58 @@ class JdotFormatter:
 
             # @ commands break out of everything, back to the root.
             if cls._is_at(token):
+                if len(stack) > 1:
+                    for sub_tokens in stack[1:]:
+                        cls._measure(sub_tokens)
+                    yield stack[1]
                 del stack[1:]
 
             # Open-paren tokens create a new nested token list, starting with their
             # open-paren token and (unless interrupted by an @) ending with their
             # close-paren token.
             elif cls._is_open(token):
-                sub_tokens = []
-                stack[-1].append(sub_tokens)
+                sub_tokens = _Tokens()
+                if len(stack) > 1:
+                    stack[-1].append(sub_tokens)
                 stack.append(sub_tokens)
 
             # Push the token to the current innermost list.
-            stack[-1].append(token)
+            if len(stack) > 1:
+                stack[-1].append(token)
+            else:
+                yield token
 
             # Close-paren tokens close the current list level.
             if cls._is_close(token) and len(stack) > 1:
-                stack.pop()
+                sub_tokens = cls._measure(stack.pop())
+                if len(stack) == 1:
+                    yield sub_tokens
+
+        if len(stack) > 1:
+            for sub_tokens in stack[1:]:
+                cls._measure(sub_tokens)
+            yield stack[1]
 
-        return root
+    @classmethod
+    def _measure(cls, tokens):
+        """Count up what _should_wrap() needs to know of a nested token list,
+        once it's complete, and return it."""
+        tokens.items = tokens.values = tokens.nested = tokens.width = 0
+        tokens.special = False
+        for token in tokens:
+            if cls._is_open(token) or cls._is_close(token):
+                continue
+            tokens.items += 1
+            if cls._is_at(token) or cls._is_comment(token):
+                tokens.special = True
+            if cls._is_nested(token):
+                tokens.nested += 1
+            else:
+                if not cls._is_key(token):
+                    tokens.values += 1
+                tokens.width += len(token)
+            tokens.width += 1
+        return tokens
 
     def _should_wrap(self, tokens, is_macro=False) -> bool:
         """Whether the given list of nested tokens should be wrapped. This is
@@ -148,11 +200,19 @@ class JdotFormatter:
         if not tokens:
             return False
 
-        # Accumulate the length of the tokens before this one.
-        for token in reversed(self._output):
-            if "\n" in token:
-                break
-            length += len(token)
+        # Start from the length of the tokens before this one.
+        length = self._column
+
+        # The values and length only grow, so _measure() has worked out
+        # whether they reach the limits.
+        if isinstance(tokens, _Tokens) and self._value_limit >= 1:
+            if not tokens.items:
+                return False
+            if tokens.special:
+                return True
+            values += tokens.values + tokens.nested * (self._value_limit - 1)
+            length += tokens.width
+            return values >= self._value_limit or length >= self._length_limit
 
         # Accumulate length and value count of tokens.
         for token in tokens:
@@ -197,18 +257,40 @@ class JdotFormatter:
         replace the whitespace with some other kind of whitespace."""
         if self._output and self._is_spacing(self._output[-1]):
             self._output.pop()
+            self._column, self._newline_at = self._undo
+
+    def _append(self, piece):
+        """Append *piece* to the output, keeping track of the current line."""
+        self._undo = (self._column, self._newline_at)
+        if "\n" in piece:
+            self._column = 0
+            self._newline_at = len(self._output)
+        else:
+            self._column += len(piece)
+        self._output.append(piece)
+
+    def _reset(self):
+        self._output = []
+        self._indent = 0
+        self._column = 0  # length of output after the last piece with a newline
+        self._newline_at = -1  # index of that piece
+        self._undo = (0, -1)  # the two before the last piece was appended
+
+    def _at_newline(self):
+        """Whether the output so far ends with a newline (and indentation)."""
+        return self._is_newline(self._output[-1])
 
     def _emit_newline(self, count=1):
         """Emit the given amount of newlines with the current indentation
         level. Overrides any previously emitted whitespace."""
         self._strip_whitespace()
-        self._output.append(count * "\n" + self._indent * self._indent_str)
+        self._append(count * "\n" + self._indent * self._indent_str)
 
     def _emit_space(self):
         """Emit a single space, overriding any previously emitted
         whitespace."""
         self._strip_whitespace()
-        self._output.append(" ")
+        self._append(" ")
 
     def _emit_token(self, token):
         """Emit the given token, followed by the minimum amount of spacing
@@ -218,10 +300,10 @@ class JdotFormatter:
 
         # Handle non-nested tokens first.
         if not self._is_nested(token):
-            self._output.append(token)
-            self._output.append(" ")
+            self._append(token)
+            self._append(" ")
             return
-        tokens = token
+        group = tokens = token
 
         # Only the last token in a list can be a close.
         close_token = None
@@ -238,7 +320,7 @@ class JdotFormatter:
         is_macro = open_token == "("
 
         # Determine whether we should wrap these tokens.
-        wrap = self._should_wrap(tokens, is_macro)
+        wrap = self._should_wrap(group, is_macro)
 
         # Emit open token, if any.
         if open_token is not None:
@@ -258,33 +340,46 @@ class JdotFormatter:
         in_comment = False
         for index, token in enumerate(tokens):
             last = index == len(tokens) - 1
+            wrap, in_comment = self._emit_value(token, last, wrap, in_comment)
 
-            # Do a hard break all the way back to indentation level 0 before
-            # any @ token.
-            if self._is_at(token):
-                self._indent = 0
-                self._emit_newline(2)
+        self._emit_close(close_token, wrap)
 
-            # Do a double newline before the first line comment in a sequence.
-            if not in_comment and self._is_comment(token):
-                self._emit_newline(2)
+    def _emit_value(self, token, last, wrap, in_comment):
+        """Emit one of the tokens in a group, given whether it is the *last*,
+        whether the group is wrapped, and whether the previous token was a
+        comment.  Returns the new values of the last two."""
 
-            if last and wrap and self._dedent_last_value and self._should_wrap(token):
-                self._indent -= 1
-                wrap = False
+        # Do a hard break all the way back to indentation level 0 before
+        # any @ token.
+        if self._is_at(token):
+            self._indent = 0
+            self._emit_newline(2)
 
-            # Emit the token.
-            self._emit_token(token)
+        # Do a double newline before the first line comment in a sequence.
+        if not in_comment and self._is_comment(token):
+            self._emit_newline(2)
 
-            # Always emit a newline after a line comment, since it's necessary
-            # to terminate it.
-            in_comment = self._is_comment(token)
-            if in_comment:
-                self._emit_newline()
+        if last and wrap and self._dedent_last_value and self._should_wrap(token):
+            self._indent -= 1
+            wrap = False
 
-            # Emit a newline after values if we're wrapping.
-            if wrap and not self._is_key(token):
-                self._emit_newline()
+        # Emit the token.
+        self._emit_token(token)
+
+        # Always emit a newline after a line comment, since it's necessary
+        # to terminate it.
+        in_comment = self._is_comment(token)
+        if in_comment:
+            self._emit_newline()
+
+        # Emit a newline after values if we're wrapping.
+        if wrap and not self._is_key(token):
+            self._emit_newline()
+
+        return wrap, in_comment
+
+    def _emit_close(self, close_token, wrap):
+        """Emit the close token of a group, if any, after its values."""
 
         # Update indentation level.
         if wrap and close_token is not None:
@@ -297,16 +392,320 @@ class JdotFormatter:
 
         # Emit close token, if any.
         if close_token is not None:
-            if not self._is_newline(self._output[-1]):
+            if not self._at_newline():
                 if close_token in self._strip_spaces:
                     self._strip_whitespace()
             self._emit_token(close_token)
 
     def __call__(self, tokens) -> str:
         """Formats the given token stream."""
-        self._output = []
-        self._indent = 0
+        self._reset()
         self._emit_token(self._preprocess(tokens))
         self._indent = 0
         self._emit_newline()
         return "".join(self._output)
+
+    def iterformat(self, tokens):
+        """Formats the given token stream like __call__(), but yields the
+        output in pieces as it goes.  Only one top-level group of tokens at a
+        time is kept in memory, rather than the whole stream and output."""
+        self._reset()
+
+        values = self._iterpreprocess(tokens)
+        lookahead = []
+
+        def pull():
+            for token in values:
+                lookahead.append(token)
+                yield token
+
+        # Whether to wrap the top level only depends on its first few values.
+        wrap = self._should_wrap(pull())
+        values = itertools.chain(lookahead, values)
+
+        # As in _emit_token(), a trailing unmatched close is the close token,
+        # so look two values ahead.
+        close_token = None
+        in_comment = False
+        token, after = next(values, None), next(values, None)
+        while token is not None:
+            if after is None and self._is_close(token):
+                close_token = token
+                break
+            after2 = next(values, None)
+            last = after is None or (after2 is None and self._is_close(after))
+            wrap, in_comment = self._emit_value(token, last, wrap, in_comment)
+            yield self._take_output()
+            token, after = after, after2
+
+        self._emit_close(close_token, wrap)
+        self._indent = 0
+        self._emit_newline()
+        yield "".join(self._output)
+
+    def _take_output(self) -> str:
+        """Remove and return the output from before the current line, which
+        won't be looked at or changed any more."""
+        i = self._newline_at
+        if i <= 0:
+            return ""
+        done = "".join(self._output[:i])
+        del self._output[:i]
+        self._newline_at = 0
+        self._undo = (self._undo[0], self._undo[1] - i)
+        return done
+
+
+class _Group:
+    "An open group of tokens in JdotStreamFormatter."
+
+    __slots__ = ("wrap", "in_comment")
+
+    def __init__(self, wrap):
+        self.wrap = wrap
+        self.in_comment = False
+
+
+_NESTED = object()  # a nested group, when scanning ahead
+_TOO_FAR = object()  # beyond the lookahead
+
+
+class JdotStreamFormatter(JdotFormatter):
+    """A JdotFormatter that formats tokens as they arrive.  Whether a group
+    wraps is decided from at most *lookahead* tokens ahead of it, so memory
+    use is bounded by that and the nesting depth, not the document size.
+
+    The output is the same as JdotFormatter's, except where a group has a
+    nested group too long to see past within the lookahead.  That nested
+    group is then taken to be the last value in its group: the group wraps
+    only if the values before it are enough to make it wrap, and with
+    dedent_last_value the nested group is dedented if it wraps itself.
+    """
+
+    def __init__(self, *args, lookahead=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lookahead = lookahead
+
+    def __call__(self, tokens) -> str:
+        """Formats the given token stream."""
+        return "".join(self.iterformat(tokens))
+
+    def iterformat(self, tokens):
+        """Formats the given token stream, yielding the output in pieces."""
+        self._tokens = (t for t in (t.strip() for t in tokens) if t)
+        self._ahead = collections.deque()
+        self._text = []  # output not yet yielded
+        self._column = 0  # length of the current line, as _should_wrap() counts
+        self._spacing = ""  # whitespace after the last token, which may change
+        self._indent = 0
+
+        groups = [_Group(self._wraps(root=True))]
+        while True:
+            token = self._next()
+            if token is None:
+                break
+
+            # @ commands break out of everything, back to the root.
+            if self._is_at(token):
+                while len(groups) > 1:
+                    groups.pop()
+                    self._after_item(groups[-1], None)
+                self._emit_item(groups[-1], token)
+
+            elif self._is_close(token):
+                if len(groups) > 1:
+                    self._emit_close(token, groups.pop().wrap)
+                    self._after_item(groups[-1], None)
+                elif self._peek(0) is None:  # closes the root, as in _emit_token()
+                    self._emit_close(token, groups[0].wrap)
+                else:
+                    self._emit_item(groups[-1], token)
+
+            elif self._is_open(token):
+                root = len(groups) == 1
+                groups.append(self._emit_open(groups[-1], token, root))
+
+            else:
+                self._emit_item(groups[-1], token)
+
+            if self._text:
+                yield "".join(self._text)
+                self._text.clear()
+
+        while len(groups) > 1:
+            groups.pop()
+            self._after_item(groups[-1], None)
+        self._indent = 0
+        self._emit_newline()
+        self._write(self._spacing)
+        yield "".join(self._text)
+
+    def _next(self):
+        """Remove and return the next token, or None at the end."""
+        if self._ahead:
+            return self._ahead.popleft()
+        return next(self._tokens, None)
+
+    def _peek(self, i):
+        """Return the token *i* ahead of the next one, None past the end, or
+        _TOO_FAR past the lookahead."""
+        if i >= self._lookahead:
+            return _TOO_FAR
+        while len(self._ahead) <= i:
+            token = next(self._tokens, None)
+            if token is None:
+                return None
+            self._ahead.append(token)
+        return self._ahead[i]
+
+    def _skip(self, i):
+        """Return the index just past the group the token at *i* is in, or
+        None if its end is past the lookahead.  A group ends at a close, an
+        @ command (not skipped), or the end of the tokens."""
+        depth = 1
+        while depth:
+            token = self._peek(i)
+            if token is _TOO_FAR:
+                return None
+            if token is None or self._is_at(token):
+                return i
+            if self._is_open(token):
+                depth += 1
+            elif self._is_close(token):
+                depth -= 1
+            i += 1
+        return i
+
+    def _upcoming(self, root=False):
+        """Yield the tokens ahead in the current group, with _NESTED in place
+        of each nested group, until the group ends or the lookahead runs out
+        (in the middle of a nested group, assumed to be the last)."""
+        i = 0
+        while True:
+            token = self._peek(i)
+            if token is None or token is _TOO_FAR:
+                return
+            if not root and (self._is_close(token) or self._is_at(token)):
+                return
+            i += 1
+            if self._is_open(token):
+                yield _NESTED
+                i = self._skip(i)
+                if i is None:
+                    return
+            else:
+                yield token
+
+    def _is_last(self, root=False):
+        """Whether the group just opened is the last value in its parent."""
+        i = self._skip(0)
+        if i is None:
+            return True
+        token = self._peek(i)
+        if token is None or token is _TOO_FAR:
+            return True
+        if root:
+            return self._is_close(token) and self._peek(i + 1) is None
+        return self._is_close(token) or self._is_at(token)
+
+    def _wraps(self, is_macro=False, root=False) -> bool:
+        """Whether the upcoming tokens of the current group should be wrapped,
+        as _should_wrap() decides."""
+        length = self._line_length()
+        values = -1 if is_macro else 0
+
+        for token in self._upcoming(root):
+            if token is _NESTED:
+                values += self._value_limit - 1
+                if values >= self._value_limit:
+                    return True
+                length += 1
+            else:
+                if self._is_open(token) or self._is_close(token):
+                    continue
+                if self._is_at(token) or self._is_comment(token):
+                    return True
+                if not self._is_key(token):
+                    values += 1
+                if values >= self._value_limit:
+                    return True
+                length += len(token) + 1
+            if length >= self._length_limit:
+                return True
+
+        return False
+
+    def _emit_open(self, parent, open_token, root=False):
+        """Emit the open token of a nested group in *parent*, and return the
+        new group.  As in _emit_token() and _emit_value()."""
+        if parent.wrap and self._dedent_last_value and self._is_last(root):
+            if self._wraps():
+                self._indent -= 1
+                parent.wrap = False
+
+        is_macro = open_token == "("
+        group = _Group(self._wraps(is_macro))
+
+        self._emit_token(open_token)
+        if open_token in self._strip_spaces:
+            self._strip_whitespace()
+
+        if group.wrap:
+            self._indent += 1
+            if not is_macro:
+                self._emit_newline()
+
+        return group
+
+    def _emit_item(self, group, token):
+        """Emit a token in *group*.  As in _emit_value()."""
+        if self._is_at(token):
+            self._indent = 0
+            self._emit_newline(2)
+
+        if not group.in_comment and self._is_comment(token):
+            self._emit_newline(2)
+
+        self._emit_token(token)
+        self._after_item(group, token)
+
+    def _after_item(self, group, token):
+        """Emit what follows a token, or a nested group if *token* is None,
+        in *group*.  As in _emit_value()."""
+        group.in_comment = self._is_comment(token)
+        if group.in_comment:
+            self._emit_newline()
+
+        if group.wrap and not self._is_key(token):
+            self._emit_newline()
+
+    def _write(self, text):
+        self._text.append(text)
+        if "\n" in text:
+            self._column = 0
+        else:
+            self._column += len(text)
+
+    def _line_length(self):
+        """The length of the current line, as _should_wrap() counts it."""
+        if "\n" in self._spacing:
+            return 0
+        return self._column + len(self._spacing)
+
+    def _at_newline(self):
+        return "\n" in self._spacing
+
+    def _strip_whitespace(self):
+        self._spacing = ""
+
+    def _emit_newline(self, count=1):
+        self._spacing = count * "\n" + self._indent * self._indent_str
+
+    def _emit_space(self):
+        self._spacing = " "
+
+    def _emit_token(self, token):
+        if self._spacing:
+            self._write(self._spacing)
+        self._write(token)
+        self._spacing = " "
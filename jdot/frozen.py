@@ -0,0 +1,48 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import types
+
+from .decoder import CompiledTemplate
+from .macroindex import MacroIndex
+
+__all__ = ["FrozenMacros"]
+
+
+class FrozenMacros:
+    """Macros and options compiled once, to be shared by any number of coders
+    (see coder()) in different threads, or inherited by forked processes.
+
+    Nothing here changes after it is made: the macro index, every matcher and
+    every template are compiled up front.  Each coder keeps its own parse
+    state, options and dict of macros, which starts out with the shared
+    templates.  A coder that defines macros of its own with `@macros` first
+    makes itself private copies of the templates, so the shared ones are
+    never changed; the templates must not be changed in place otherwise."""
+
+    def __init__(self, coder):
+        "Freeze the macros and options of *coder*, reusing what it has compiled."
+        macros = coder.macros.copy()  # with the same stamps, to share compiled_macros
+        index = coder.macroindex
+        if index is None or not index.is_current(macros):
+            index = MacroIndex(macros)
+        index.compile()
+
+        compiled = {}
+        for name, template in macros.items():
+            c = coder.compiled_macros.get(name)
+            stamp = macros.stamps.get(name)
+            if c is None or not c.is_current(template, stamp):
+                c = CompiledTemplate(template, stamp)
+            compiled[name] = c
+
+        self.macros = types.MappingProxyType(macros)  # whose copy() is a Macros
+        self.options = types.MappingProxyType(dict(coder.options))
+        self.macroindex = index
+        self.compiled_macros = types.MappingProxyType(compiled)
+
+    def coder(self, **kwargs):
+        """Return a new JdotCoder using these macros, with these options updated
+        by *kwargs*."""
+        from . import JdotCoder
+
+        return JdotCoder(frozen=self, **kwargs)
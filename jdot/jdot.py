@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: Apache-2.0
 
+import types
+import builtins
+import pickle
+import hashlib
+import marshal
+import itertools
+import importlib.util
+
 
 class Variable:
     def __init__(self, key=""):
@@ -10,36 +18,249 @@ class Variable:
     def __repr__(self):
         return "?" + self.key
 
+    def __reduce__(self):
+        return (Variable, (self.key,))
+
+
+def function_state(f):
+    """Return the state of generated function *f* (its compiled code and its
+    globals but for its builtins), to be pickled and rebuilt by
+    restore_function()."""
+    g = {k: v for k, v in f.__globals__.items() if k != "__builtins__" and v is not f}
+    return (importlib.util.MAGIC_NUMBER, marshal.dumps(f.__code__), g)
+
+
+def restore_function(state):
+    """Return the function from function_state(), without compiling it again.
+    Return None if it was compiled by a different version of Python."""
+    magic, code, g = state
+    if magic != importlib.util.MAGIC_NUMBER:
+        return None
+    g["__builtins__"] = builtins  # not filled in before Python 3.10
+    return types.FunctionType(marshal.loads(code), g)
+
 
 class InnerDict(dict):
     "instantiate only the inner keys and not the dict itself"
     pass
 
 
-def deep_update(a: dict, b: dict, type=lambda v: v):
+_versions = itertools.count(1)  # shared, so a version means the same in any copy
+
+
+class Macros(dict):
+    """The macros of a coder by name, keeping track of changes, so that what
+    is compiled from them is only rebuilt after they change.  *version* is
+    new after every change, and *stamps* has the version at which each macro
+    was last set.  A template changed in place is only noticed once it is
+    set again, as by `macros[name] = template`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.version = 0
+        self.stamps = {}  # name -> version
+        self._fingerprint = (None, None)  # (version, digest)
+        self.update(*args, **kwargs)
+
+    def _changed(self, names=()):
+        self.version = next(_versions)
+        for name in names:
+            self.stamps[name] = self.version
+
+    def __setitem__(self, name, template):
+        super().__setitem__(name, template)
+        self._changed((name,))
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        del self.stamps[name]
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        new = dict(*args, **kwargs)
+        super().update(new)
+        self._changed(new)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, name, template=None):
+        if name not in self:
+            self[name] = template
+        return self[name]
+
+    def pop(self, name, *default):
+        if name not in self:
+            return super().pop(name, *default)
+        template = super().pop(name)
+        del self.stamps[name]
+        self._changed()
+        return template
+
+    def popitem(self):
+        name, template = super().popitem()
+        del self.stamps[name]
+        self._changed()
+        return name, template
+
+    def clear(self):
+        super().clear()
+        self.stamps.clear()
+        self._changed()
+
+    def copy(self):
+        "Return a copy with the same version and stamps, as current as this."
+        ret = Macros()
+        dict.update(ret, self)
+        ret.version = self.version
+        ret.stamps = dict(self.stamps)
+        ret._fingerprint = self._fingerprint
+        return ret
+
+    def fingerprint(self) -> bytes:
+        """Return a digest of the pickled macros, the same for equal macros.
+        It is only computed again after they change."""
+        version, digest = self._fingerprint
+        if version != self.version:
+            data = pickle.dumps(dict(self), protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hashlib.sha256(data).digest()
+            self._fingerprint = (self.version, digest)
+        return digest
+
+    def __reduce__(self):
+        # changes made elsewhere are new here: versions are not pickled
+        return (Macros, (dict(self),))
+
+
+def _run(gen):
+    """Run generator *gen* to completion and return its value.  Rather than
+    recursing, it yields a generator for each call it would make, and is
+    sent back that call's value, so the calls run from an explicit stack."""
+    stack = [gen]
+    value = None
+    while stack:
+        try:
+            call = stack[-1].send(value)
+        except StopIteration as e:
+            stack.pop()
+            value = e.value
+        else:
+            stack.append(call)
+            value = None
+    return value
+
+
+def _same(v):
+    return v
+
+
+def deep_update(a: dict, b: dict, type=_same):
     """"""
     if not b:
         return a
 
-    for k, vb in b.items():
-        va = a.get(k, None)
-        if isinstance(va, dict) and isinstance(vb, dict):
-            deep_update(va, vb)
-        elif isinstance(va, list):
-            va.append(vb)
+    # a nested dict is updated as soon as it is found, like a recursive call
+    stack = [(a, iter(b.items()), type)]
+    while stack:
+        x, items, convert = stack[-1]
+        for k, vb in items:
+            va = x.get(k, None)
+            if isinstance(va, dict) and isinstance(vb, dict):
+                stack.append((va, iter(vb.items()), _same))
+                break
+            elif isinstance(va, list):
+                va.append(vb)
+            else:
+                x[k] = convert(vb)
         else:
-            a[k] = type(vb)
+            stack.pop()
     return a
 
 
-def deep_match(a, b):
-    "Return dict of matches between a and b if a and b are dicts/lists and a and b are exact matches, or boolean equality otherwise."
+_DEEPER = object()
+
+
+def _match_shallow(a, b):
+    "Return deep_match(a, b), or _DEEPER if it has to compare their contents."
     if isinstance(b, Variable):  # Variables match anything
         if b.key == "?":  # match but don't return value
             return {}
         return {b.key: a}
 
     elif isinstance(a, dict) and isinstance(b, dict):
+        return _DEEPER
+
+    elif isinstance(a, list) and isinstance(b, list):
+        return _DEEPER
+
+    return a == b
+
+
+_INDEX_MIN = 16  # shorter lists are searched item by item
+
+
+class _ListIndex:
+    """The items of list *a* bucketed by type, by value, and by the keys of
+    dicts, to find the items that a template item might match without trying
+    every one of them."""
+
+    def __init__(self, a):
+        self.a = a
+        self.dicts = []  # indices of dict items
+        self.lists = []  # indices of list items
+        self.by_keys = {}  # frozenset of keys -> indices of dicts with just those
+        self.by_value = {}  # hashable value -> indices of items equal to it
+        self.unhashable = []  # indices of other items
+        self.wild = False  # whether any dict item has an empty key
+        for i, y in enumerate(a):
+            if isinstance(y, dict):
+                self.dicts.append(i)
+                if "" in y:
+                    self.wild = True
+                else:
+                    self.by_keys.setdefault(frozenset(y), []).append(i)
+            elif isinstance(y, list):
+                self.lists.append(i)
+            else:
+                try:
+                    self.by_value.setdefault(y, []).append(i)
+                except TypeError:
+                    self.unhashable.append(i)
+
+    def candidates(self, b):
+        """Return the indices of the items that template item *b* might match,
+        in order."""
+        if isinstance(b, Variable):
+            return range(len(self.a))
+
+        if isinstance(b, dict):
+            if isinstance(b, InnerDict) or "" in b or self.wild:
+                keys = [k for k in b if k]
+                return [i for i in self.dicts if all(k in self.a[i] for k in keys)]
+            return self.by_keys.get(frozenset(b), ())
+
+        if isinstance(b, list):
+            return self.lists
+
+        try:
+            found = self.by_value.get(b, [])
+        except TypeError:
+            return range(len(self.a))
+        if self.unhashable:
+            return sorted(found + self.unhashable)
+        return found
+
+
+def _list_candidates(a, index, b):
+    "The items of list *a* that template item *b* might match, in order."
+    if index is None:
+        return a
+    return [a[i] for i in index.candidates(b)]
+
+
+def _deep_match(a, b):
+    if isinstance(a, dict):
         if not isinstance(b, InnerDict):
             keydiffs = set(a.keys()) ^ set(b.keys())
             if keydiffs and "" not in keydiffs:
@@ -50,7 +271,9 @@ def deep_match(a, b):
                 continue
             if k not in a:  # all `k` in `b` must be in `a` to match
                 return False
-            m = deep_match(a[k], v)
+            m = _match_shallow(a[k], v)
+            if m is _DEEPER:
+                m = yield _deep_match(a[k], v)
             if m is False:  # values must match
                 return False
             if isinstance(m, dict):
@@ -58,11 +281,14 @@ def deep_match(a, b):
 
         return ret
 
-    elif isinstance(a, list) and isinstance(b, list):
+    else:
         ret = False
+        index = _ListIndex(a) if len(a) >= _INDEX_MIN else None
         for x in b:
-            for y in a:
-                m = deep_match(y, x)
+            for y in _list_candidates(a, index, x):
+                m = _match_shallow(y, x)
+                if m is _DEEPER:
+                    m = yield _deep_match(y, x)
                 if m is False:  # each item in `b` must match at least one item in `a`
                     continue
                 if isinstance(m, dict):
@@ -72,11 +298,16 @@ def deep_match(a, b):
                     break
         return ret
 
-    return a == b
+
+def deep_match(a, b):
+    "Return dict of matches between a and b if a and b are dicts/lists and a and b are exact matches, or boolean equality otherwise."
+    m = _match_shallow(a, b)
+    if m is _DEEPER:
+        return _run(_deep_match(a, b))
+    return m
 
 
-def deep_del(a: dict, b: dict):
-    "deep remove contents of *b* from *a*."
+def _deep_del(a: dict, b: dict, copy_inner=False):
     for k, v in b.items():
         if not k:
             a.clear()
@@ -89,7 +320,9 @@ def deep_del(a: dict, b: dict):
                 continue
 
             assert isinstance(v, dict), v
-            deep_del(a[k], v)
+            if copy_inner:
+                a[k] = a[k].copy()
+            yield _deep_del(a[k], v, copy_inner)
             if not a[k]:  # remove empty dicts
                 del a[k]
 
@@ -99,22 +332,43 @@ def deep_del(a: dict, b: dict):
                 continue
 
             assert isinstance(v, list), v
+            # remove the first remaining item matching each needle, in one pass
+            items = a[k]
+            index = _ListIndex(items) if len(items) >= _INDEX_MIN else None
+            removed = set()
             for needle in v:
-                for i, item in enumerate(a[k]):
-                    if deep_match(item, needle) is not False:
-                        deep_del(item, needle)
-                        del a[k][i]
-                        if not a[k]:
-                            del a[k]
+                found = index.candidates(needle) if index else range(len(items))
+                for i in found:
+                    if i not in removed and deep_match(items[i], needle) is not False:
+                        removed.add(i)
                         break
+            if removed:
+                items = [y for i, y in enumerate(items) if i not in removed]
+                if items:
+                    a[k] = items
+                else:
+                    del a[k]
         else:
             del a[k]
 
 
+def deep_del(a: dict, b: dict, copy_inner=False):
+    """deep remove contents of *b* from *a*.  If *copy_inner*, the dicts and
+    lists inside *a* are replaced by smaller copies rather than changed, so
+    that only *a* itself is changed."""
+    _run(_deep_del(a, b, copy_inner))
+
+
 def deep_len(x):
     "returns the amount of primitive values in a nested structure."
-    if isinstance(x, dict):
-        return sum(map(deep_len, x.values()))
-    elif isinstance(x, list):
-        return sum(map(deep_len, x))
-    return 1
+    n = 0
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, dict):
+            stack.extend(x.values())
+        elif isinstance(x, list):
+            stack.extend(x)
+        else:
+            n += 1
+    return n
@@ -0,0 +1,302 @@
+# SPDX-License-Identifier: Apache-2.0
+
+from .jdot import (
+    InnerDict,
+    Variable,
+    deep_match,
+    deep_update,
+    function_state,
+    restore_function,
+)
+
+__all__ = ["MacroIndex", "CompiledMatcher"]
+
+
+_PRESENT = object()  # pin for a key that must be present, with any value
+
+
+class _Node:
+    """A node of the discrimination tree.  Macros in *done* have passed every
+    test on the way here.  The rest test *key*: in *branches* by value, in
+    *present* for any value, and in *skip* not at all."""
+
+    __slots__ = ("done", "key", "branches", "present", "skip")
+
+    def __init__(self):
+        self.done = []
+        self.key = None
+        self.branches = {}
+        self.present = None
+        self.skip = None
+
+
+class CompiledMatcher:
+    """A dict template compiled into *match*, a function giving the same
+    result as deep_match(obj, template) for any dict *obj*.  Templates that
+    bind a variable more than once, have an empty key, or nest too deeply are
+    left to deep_match.  Pickles with its generated code."""
+
+    max_depth = 50
+
+    def __init__(self, template):
+        self.template = template
+        self.match = lambda obj: deep_match(obj, template)
+        self.compiled = False  # whether *match* is generated code
+
+        if not isinstance(template, dict):
+            return
+
+        consts = dict(deep_match=deep_match, deep_update=deep_update)
+        lines = []
+        try:
+            self._source(template, "a", lines, consts, set(), 0)
+        except ValueError:
+            return
+
+        body = "".join(f"    {line}\n" for line in lines)
+        exec(f"def match(a):\n    r = {{}}\n{body}    return r\n", consts)
+        self.match = consts["match"]
+        self.compiled = True
+
+    def __getstate__(self):
+        return (self.template, function_state(self.match) if self.compiled else None)
+
+    def __setstate__(self, state):
+        template, fstate = state
+        match = restore_function(fstate) if fstate is not None else None
+        if match is None:
+            self.__init__(template)
+        else:
+            self.template = template
+            self.match = match
+            self.compiled = True
+
+    def _source(self, v, var, lines, consts, names, depth):
+        "Append to *lines* the tests of dict *var* against dict template *v*."
+        if depth > self.max_depth:
+            raise ValueError("template too deep to compile")
+        if "" in v:
+            raise ValueError("empty key")
+
+        if not isinstance(v, InnerDict):
+            keys = self._const(frozenset(v), consts)
+            lines.append(f'if {var}.keys() != {keys} and "" not in {var}:')
+            lines.append("    return False")
+
+        for k, x in v.items():
+            lines.append(f"if {k!r} not in {var}: return False")
+            item = f"{var}[{k!r}]"
+            if isinstance(x, Variable):
+                if x.key == "?":
+                    continue
+                if x.key in names:
+                    raise ValueError("variable bound twice")
+                names.add(x.key)
+                lines.append(f"r[{x.key!r}] = {item}")
+            elif isinstance(x, dict):
+                sub = f"a{depth + 1}"
+                lines.append(f"{sub} = {item}")
+                lines.append(f"if not isinstance({sub}, dict): return False")
+                self._source(x, sub, lines, consts, names, depth + 1)
+            elif isinstance(x, list):
+                for key in self._variables(x):
+                    if key in names:
+                        raise ValueError("variable bound twice")
+                    names.add(key)
+                lines.append(f"m = deep_match({item}, {self._const(x, consts)})")
+                lines.append("if m is False: return False")
+                lines.append("if isinstance(m, dict): deep_update(r, m)")
+            else:
+                lines.append(f"if ({item} == {self._const(x, consts)}) is False:")
+                lines.append("    return False")
+
+    @staticmethod
+    def _const(v, consts):
+        if type(v) in (str, int, bool, type(None)):
+            return repr(v)
+        name = f"c{len(consts)}"
+        consts[name] = v
+        return name
+
+    @staticmethod
+    def _variables(v):
+        "Yield the keys of the Variables bound anywhere in *v*."
+        stack = [v]
+        while stack:
+            v = stack.pop()
+            if isinstance(v, Variable):
+                if v.key != "?":
+                    yield v.key
+            elif isinstance(v, dict):
+                stack.extend(v.values())
+            elif isinstance(v, list):
+                stack.extend(v)
+
+
+class MacroIndex:
+    """The macro templates compiled together into a discrimination tree, which
+    tests each key and literal value they require of a dict once, to find
+    the macros that might match it without trying every one of them.
+
+    Rebuild after changing macros; is_current() notices any change made
+    through Macros by its version, and added, removed, or replaced macros in
+    a plain dict."""
+
+    def __init__(self, macros: dict):
+        self.items = list(macros.items())
+        self.matchers = [None] * len(self.items)  # compiled on first use
+        self.version = getattr(macros, "version", None)  # of Macros
+
+        entries = []  # (pins, i)
+        for i, (name, macro) in enumerate(self.items):
+            if isinstance(macro, Variable):
+                entries.append(((), i))
+            elif isinstance(macro, dict):
+                entries.append((self._pins(macro), i))
+            # scalars and lists never match a dict
+
+        # test the keys most macros depend on first, to share the tests
+        counts = {}
+        for pins, i in entries:
+            for k, v in pins:
+                counts[k] = counts.get(k, 0) + 1
+        keys = sorted(counts, key=counts.get, reverse=True)
+        order = {k: n for n, k in enumerate(keys)}
+        entries = [(sorted(pins, key=lambda p: order[p[0]]), i) for pins, i in entries]
+
+        self.tree = self._build(entries, order)
+
+    @staticmethod
+    def _pins(macro):
+        "Return (key, literal value or _PRESENT) for each key *macro* requires."
+        pins = []
+        for k, v in macro.items():
+            if not k:
+                continue
+            if isinstance(v, (dict, list, Variable)):
+                pins.append((k, _PRESENT))
+                continue
+            try:
+                hash(v)
+            except TypeError:
+                v = _PRESENT
+            pins.append((k, v))
+        return pins
+
+    @staticmethod
+    def _build(entries, order):
+        root = _Node()
+        work = [(root, entries)]
+        while work:
+            node, entries = work.pop()
+            rest = []
+            for pins, i in entries:
+                if pins:
+                    rest.append((pins, i))
+                else:
+                    node.done.append(i)
+            if not rest:
+                continue
+
+            node.key = min((pins[0][0] for pins, i in rest), key=order.get)
+            groups = {}
+            present = []
+            skip = []
+            for pins, i in rest:
+                k, v = pins[0]
+                if k != node.key:
+                    skip.append((pins, i))
+                elif v is _PRESENT:
+                    present.append((pins[1:], i))
+                else:
+                    groups.setdefault(v, []).append((pins[1:], i))
+
+            for v, group in groups.items():
+                node.branches[v] = _Node()
+                work.append((node.branches[v], group))
+            if present:
+                node.present = _Node()
+                work.append((node.present, present))
+            if skip:
+                node.skip = _Node()
+                work.append((node.skip, skip))
+
+        return root
+
+    def compile(self):
+        "Compile the matchers of all macros now, instead of on first use."
+        for i, (name, macro) in enumerate(self.items):
+            if self.matchers[i] is None and isinstance(macro, (dict, Variable)):
+                self.matchers[i] = CompiledMatcher(macro)
+
+    def __getstate__(self):
+        # the tree as a list of nodes, so that pickle does not recurse down it
+        nodes = [self.tree]
+        flat = []
+
+        def index(node):
+            if node is None:
+                return None
+            nodes.append(node)
+            return len(nodes) - 1
+
+        for node in nodes:  # grows as children are numbered
+            branches = {v: index(child) for v, child in node.branches.items()}
+            flat.append(
+                (node.done, node.key, branches, index(node.present), index(node.skip))
+            )
+        return (self.items, self.matchers, flat)  # not the version, only valid here
+
+    def __setstate__(self, state):
+        self.items, self.matchers, flat = state
+        self.version = None
+        nodes = [_Node() for _ in flat]
+        for node, (done, key, branches, present, skip) in zip(nodes, flat):
+            node.done = done
+            node.key = key
+            node.branches = {v: nodes[n] for v, n in branches.items()}
+            node.present = None if present is None else nodes[present]
+            node.skip = None if skip is None else nodes[skip]
+        self.tree = nodes[0]
+
+    def is_current(self, macros: dict) -> bool:
+        "Whether this index was built from the current contents of *macros*."
+        version = getattr(macros, "version", None)
+        if version is not None:
+            return version == self.version
+        if len(macros) != len(self.items):
+            return False
+        return all(macros.get(name, self) is macro for name, macro in self.items)
+
+    def candidates(self, obj: dict, start: int = 0) -> list:
+        """Return (i, name, macro) for each macro from the *start*th on that
+        might match *obj*, in macro order."""
+        found = []
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            while node is not None:
+                found.extend(node.done)
+                if node.key in obj:
+                    if node.present is not None:
+                        stack.append(node.present)
+                    try:
+                        child = node.branches.get(obj[node.key])
+                    except TypeError:  # unhashable values never equal a literal
+                        child = None
+                    if child is not None:
+                        stack.append(child)
+                node = node.skip
+
+        return [(i, *self.items[i]) for i in sorted(found) if i >= start]
+
+    def matches(self, obj: dict, start: int = 0):
+        """Yield (i, name, macro, bindings) for each macro from the *start*th on
+        that matches *obj*, in macro order, with bindings as from deep_match."""
+        for i, name, macro in self.candidates(obj, start):
+            matcher = self.matchers[i]
+            if matcher is None:
+                matcher = self.matchers[i] = CompiledMatcher(macro)
+            m = matcher.match(obj)
+            if m is not False:
+                yield i, name, macro, m
@@ -0,0 +1,326 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import re
+import json
+import functools
+import collections
+
+from .encoder import _needs_quotes_re, _literal_str
+
+__all__ = ["MacroMiner", "MinedMacro", "mine_macros", "iterjson"]
+
+
+MinedMacro = collections.namedtuple("MinedMacro", "name template count savings")
+
+_KEYWORDS = ("true", "false", "null")
+
+
+def _key_token(k):
+    "The token for dict key *k*, as the encoder writes it."
+    return f".{_literal_str(k)}" if _needs_quotes_re.search(k) else f".{k}"
+
+
+@functools.lru_cache(maxsize=4096)
+def _key_len(k):
+    "The length of the token for key *k* with the spaces around it."
+    return len(_key_token(k)) + 2
+
+
+def _literal(v):
+    "The literal for scalar *v*, as the encoder writes it."
+    if isinstance(v, str):
+        return _literal_str(v) if v else '""'
+    elif v is True:
+        return "true"
+    elif v is False:
+        return "false"
+    elif v is None:
+        return "null"
+    return f"{v}"
+
+
+def _name(s, default):
+    "A macro or variable name made from key *s*, or *default*."
+    name = re.sub(r"[^A-Za-z0-9_-]+", "_", s or "").strip("_-")[:24]
+    if not name:
+        return default
+    if not name[0].isalpha():
+        name = f"{default}_{name}"
+    if name in _KEYWORDS:
+        name += "_"
+    return name
+
+
+def _has_list(v):
+    "Whether there is a list in *v*, which a template only matches by variables."
+    stack = [v]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, (list, tuple)):
+            return True
+        elif isinstance(v, dict):
+            stack.extend(v.values())
+    return False
+
+
+class _Shape:
+    "The dicts seen with one set of keys."
+
+    __slots__ = ("count", "parent", "keys", "consts")
+
+    def __init__(self, keys, parent):
+        self.count = 0
+        self.parent = parent  # key of the first of them seen inside another dict
+        self.keys = sorted(keys)
+        self.consts = {}  # key -> (hash, value) while it has not varied
+
+
+class MacroMiner:
+    """Count the dict shapes and long strings that repeat in a corpus, to
+    suggest the macros that would make its jdot smallest.
+
+    Feed it one value at a time with add(); each is walked once and not
+    kept.  A dict shape is the set of keys of a dict; its macro takes the
+    values as arguments, except the values that were the same in every dict
+    of that shape seen, which are kept in the template (except lists, as
+    templates only match lists by their variables).  Subtrees are
+    compared by hash, bottom up, so walking a value takes time linear in its
+    size.  At most *capacity* shapes and strings are counted at a time: when
+    there are more, the least frequent half are dropped and counting of them
+    starts over, so memory stays bounded however large the corpus, and the
+    counts of rare shapes are underestimated.
+
+    Savings are estimated from the one-line encoding without other macros,
+    counting each use and the definition once; macros that overlap (a long
+    string kept in a template, say) are counted separately."""
+
+    def __init__(self, capacity=10000, min_count=2, min_string=10):
+        self.capacity = capacity
+        self.min_count = min_count
+        self.min_string = min_string  # shortest string literal to count
+        self.shapes = {}  # frozenset of keys -> _Shape
+        self.strings = {}  # str -> [count, parent key]
+        self.values = 0  # values added
+        self.size = 0  # length of their one-line encoding without macros
+
+    def add(self, obj):
+        "Count the subtrees of *obj*."
+        self.values += 1
+        if not obj or not isinstance(obj, (dict, list, tuple)):
+            if type(obj) is str and len(_literal_str(obj)) >= self.min_string:
+                self._add_string(obj, None)
+            if isinstance(obj, dict):
+                self.size += 2
+            else:
+                self.size += 3 if isinstance(obj, (list, tuple)) else len(_literal(obj))
+            return
+
+        done = {}  # id -> (hash, length) of the containers done
+        stack = [(obj, None, False)]
+        while stack:
+            x, parent, expanded = stack.pop()
+            items = x.items() if isinstance(x, dict) else ((parent, v) for v in x)
+            if not expanded:  # do the containers inside first
+                stack.append((x, parent, True))
+                for k, v in items:
+                    if v and isinstance(v, (dict, list, tuple)):
+                        stack.append((v, k, False))
+                continue
+
+            hashes = []
+            n = 0  # length of the values
+            for k, v in items:
+                if type(v) is str:
+                    vn = len(_literal_str(v)) if v else 2
+                    if vn >= self.min_string:
+                        self._add_string(v, k)
+                    hashes.append(hash(v))
+                elif isinstance(v, (dict, list, tuple)):
+                    if v:
+                        vh, vn = done[id(v)]
+                    else:
+                        vh, vn = hash(type(v)), 2 if isinstance(v, dict) else 3
+                    hashes.append(vh)
+                else:
+                    vn = len(_literal(v))
+                    try:
+                        hashes.append(hash((type(v), v)))
+                    except TypeError:
+                        hashes.append(hash((type(v), repr(v))))
+                n += vn
+
+            if isinstance(x, dict):
+                done[id(x)] = self._add_dict(x, parent, hashes, n)
+            else:
+                done[id(x)] = (hash((list, tuple(hashes))), 3 + len(x) + n)
+
+        n = done[id(obj)][1]
+        if not isinstance(obj, dict) or len(obj) > 1:  # left off at the top level
+            n -= 4
+        self.size += n
+
+    def _add_dict(self, d, parent, hashes, n):
+        """Count dict *d*, given the hashes of its values and the sum of their
+        lengths.  Return its own hash and length, inside another value."""
+        n += sum([_key_len(k) for k in d]) - 1
+        if len(d) > 1:  # braces are left off dicts of one key
+            n += 4
+        h = hash(frozenset(zip(d, hashes)))
+
+        if "" in d:  # an empty key in a template matches any other keys
+            return h, n
+        keys = frozenset(d)
+        shape = self.shapes.get(keys)
+        if shape is None:
+            self._prune(self.shapes, lambda s: s.count)
+            shape = self.shapes[keys] = _Shape(keys, parent)
+            shape.consts = {k: (vh, v) for (k, v), vh in zip(d.items(), hashes)}
+        elif shape.consts:
+            consts = shape.consts
+            for k, vh in zip(d, hashes):
+                c = consts.get(k)
+                if c is not None and c[0] != vh:
+                    del consts[k]
+        shape.count += 1
+        return h, n
+
+    def _add_string(self, s, parent):
+        entry = self.strings.get(s)
+        if entry is None:
+            self._prune(self.strings, lambda e: e[0])
+            entry = self.strings[s] = [0, parent]
+        entry[0] += 1
+
+    def _prune(self, table, count):
+        "Make room in *table* by dropping the less frequent half, if full."
+        if len(table) < self.capacity:
+            return
+        keep = sorted(table.items(), key=lambda kv: count(kv[1]), reverse=True)
+        table.clear()
+        table.update(keep[: self.capacity // 2])
+
+    def _candidates(self, encode):
+        """Yield (name, template, count, bytes saved per use by a macro with
+        an empty name) for each shape and string seen often enough."""
+        for shape in self.shapes.values():
+            if shape.count >= self.min_count:
+                template, per_use = self._template(shape, encode)
+                yield _name(shape.parent, "m"), template, shape.count, per_use
+        for s, (count, parent) in self.strings.items():
+            if count >= self.min_count:
+                template = _literal(s)
+                yield _name(parent, "s"), template, count, len(template)
+
+    def _template(self, shape, encode):
+        "Return the template text for *shape*, and the bytes it saves per use."
+        parts = []
+        names = set()
+        per_use = 0  # what is left out of each use
+        nvars = 0
+        for i, k in enumerate(shape.keys):
+            per_use += _key_len(k)
+            c = shape.consts.get(k)
+            if c is not None and not _has_list(c[1]):
+                v = c[1]
+                text = encode(v)
+                if v and isinstance(v, dict):  # left off at the top level
+                    text = f"{{ {text} }}"
+                elif v and isinstance(v, (list, tuple)):
+                    text = f"[ {text} ]"
+                parts.append(f"{_key_token(k)} {text}")
+                per_use += len(text)
+                continue
+            var = _name(k, "v")
+            if var in names:
+                var = f"v{i}"
+            names.add(var)
+            parts.append(f"{_key_token(k)} ?{var}")
+            nvars += 1
+
+        # "{ .k v .l w }" becomes "name", or "( name v w )"
+        per_use += 3 if nvars == 0 else -1 - nvars
+        if len(shape.keys) == 1:  # ".k v", without braces
+            per_use -= 4
+        return "{ " + " ".join(parts) + " }", per_use
+
+    def macros(self, limit=20) -> list:
+        """Return the *limit* macros estimated to save the most, as MinedMacro
+        (name, template text, count, estimated savings), most savings first."""
+        from . import JdotCoder
+
+        encode = JdotCoder().encode_oneliner
+        found = sorted(
+            self._candidates(encode),
+            key=lambda c: c[2] * (c[3] - 1) - len(c[1]),
+            reverse=True,
+        )
+
+        ret = []
+        names = set()
+        for name, template, count, per_use in found:
+            if len(ret) >= limit:
+                break
+            unique = name
+            i = 2
+            while unique in names:
+                unique = f"{name}{i}"
+                i += 1
+
+            savings = count * (per_use - len(unique))
+            savings -= len(f".{unique} {template} ")  # the definition
+            if savings > 0:
+                names.add(unique)
+                ret.append(MinedMacro(unique, template, count, savings))
+
+        ret.sort(key=lambda m: m.savings, reverse=True)
+        return ret
+
+    def format(self, limit=20) -> str:
+        "Return an `@macros` block of the best macros(), with their savings."
+        lines = [f"# {self.values} values, about {self.size} bytes as jdot"]
+        lines.append("@macros")
+        for m in self.macros(limit):
+            lines.append(f"# {m.count} uses, saves about {m.savings} bytes")
+            lines.append(f".{m.name} {m.template}")
+        return "\n".join(lines) + "\n"
+
+
+def mine_macros(objs, limit=20, **kwargs) -> str:
+    """Return an `@macros` block of the *limit* macros that would shrink the
+    jdot of the values in iterable *objs* the most.  *kwargs* are passed to
+    MacroMiner."""
+    miner = MacroMiner(**kwargs)
+    for obj in objs:
+        miner.add(obj)
+    return miner.format(limit)
+
+
+def iterjson(fp, chunksize=65536):
+    """Yield each JSON value in file object *fp* (JSON Lines, or values one
+    after another), reading *chunksize* characters at a time."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                return
+            buf, pos = fp.read(chunksize), 0
+            eof = not buf
+            continue
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+        if end is None or (end == len(buf) and not eof):  # may be cut short
+            more = fp.read(max(chunksize, len(buf) - pos))  # doubles the buffer
+            eof = not more
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield obj
+        pos = end
@@ -0,0 +1,89 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import pickle
+
+from .decoder import CompiledTemplate
+from .macroindex import MacroIndex
+
+__all__ = ["dumps", "loads", "dump", "load", "SnapshotError"]
+
+
+MAGIC = b"JDOTSNAP"
+VERSION = 5
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def dumps(coder, precompile=True) -> bytes:
+    """Return a binary snapshot of the macros and options of *coder*, with the
+    MacroIndex and the compiled templates and matchers.  If *precompile*,
+    first compile everything that would otherwise be compiled on first use,
+    so that a coder loaded from the snapshot does not have to."""
+    macros = coder.macros
+    index = coder.macroindex
+    if index is None or not index.is_current(macros):
+        index = coder.macroindex = MacroIndex(macros)
+
+    compiled = coder.compiled_macros
+    if precompile:
+        index.compile()
+        for name, template in macros.items():
+            c = compiled.get(name)
+            stamp = macros.stamps.get(name)
+            if c is None or not c.is_current(template, stamp):
+                compiled[name] = CompiledTemplate(template, stamp)
+
+    # only the compiled templates of the current macros
+    compiled = {
+        name: c
+        for name, c in compiled.items()
+        if c.is_current(macros.get(name, compiled), macros.stamps.get(name))
+    }
+    # pickled together, so the index and templates share the loaded macros
+    state = (macros, coder.options, index, compiled)
+    return (
+        MAGIC
+        + VERSION.to_bytes(2, "big")
+        + pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    )
+
+
+def loads(data: bytes, coder=None):
+    """Load the snapshot *data* from dumps() into *coder*, replacing its
+    macros and updating its options.  If *coder* is None, load into a new
+    JdotCoder.  Return the coder."""
+    if data[: len(MAGIC)] != MAGIC:
+        raise SnapshotError("not a jdot snapshot")
+    version = int.from_bytes(data[len(MAGIC) : len(MAGIC) + 2], "big")
+    if version != VERSION:
+        raise SnapshotError(f"unsupported jdot snapshot version {version}")
+
+    macros, options, index, compiled = pickle.loads(memoryview(data)[len(MAGIC) + 2 :])
+
+    if coder is None:
+        from . import JdotCoder
+
+        coder = JdotCoder()
+    coder.macros.clear()  # in place, as globals['macros'] refers to it
+    coder.macros.update(macros)
+    coder.options.update(options)
+    coder.compiled_macros.clear()
+    coder.compiled_macros.update(compiled)
+    for name, c in compiled.items():  # compiled from the macros just set
+        c.stamp = coder.macros.stamps[name]
+    coder.restart()
+    index.version = coder.macros.version  # built from the macros just set
+    coder.macroindex = index  # after restart(), which drops it
+    return coder
+
+
+def dump(coder, fp, precompile=True):
+    "Write a snapshot of *coder* to binary file object *fp*."
+    fp.write(dumps(coder, precompile))
+
+
+def load(fp, coder=None):
+    "Load a snapshot from binary file object *fp*.  Return the coder."
+    return loads(fp.read(), coder)
@@ -1,8 +1,25 @@
 # SPDX-License-Identifier: Apache-2.0
 
+import io
+import sys
+import builtins
+import copy
+import pickle
+import asyncio
+import concurrent.futures
+
 import pytest
 
-from jdot import JdotCoder
+from jdot import JdotCoder, JdotFormatter, JdotStreamFormatter, DecodeCache
+from jdot import MacroMiner, mine_macros
+from jdot.cache import CacheInfo
+from jdot import snapshot
+from jdot.snapshot import SnapshotError
+from jdot.decoder import DecodeException
+from jdot.encoder import _MatchMemo
+from jdot.jdot import deep_match, deep_del, Variable, InnerDict
+from jdot.macroindex import CompiledMatcher
+from jdot.mining import iterjson
 
 
 @pytest.mark.parametrize(
@@ -25,6 +42,7 @@ def test_decode(s, out):
     [
         ".a 1 .b 2",
         '.k .int 1 .float 3.14 .str "foo" .bt true .bf false .n null',
+        ".a 1",
         '.k .k2 .a "a" .list [ 1 2 3 4 ]',
         ".a .b .c .d [ [ 1 2 ] [ 3 4 ] ]",
         "1 1.5 2.5 3.0 0.54",
@@ -60,6 +78,10 @@ def test_roundtrip_jdot(s):
             "{ .f 1 .g 2 } { .f 3 .g 4 }",
         ),  # b) makes sense
         ([{"f": 1, "g": 2}], "{ .f 1 .g 2 }"),  # c) follows from above
+        ({"a b": "x"}, '."a b" "x"'),
+        ({"s": "a\\b'c"}, '.s "a\\\\b\'c"'),
+        ({"s": 'a""b\''}, ".s 'a\"\"b\\''"),
+        ({"s": ["x" * 150] * 2}, '.s [ "' + "x" * 150 + '" "' + "x" * 150 + '" ]'),
     ],
 )
 def test_roundtrip_dict(obj, enc):
@@ -146,3 +168,668 @@ def test_decode_reencode(s, out):
     assert (
         " ".join(["@macros", macrodefs, "@output", j.encode_oneliner(d)]) == s
     )  # re-macroed
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        '.k .int 1 .float 3.14 .str "foo" .bt true .bf false .n null',
+        ".a 1",
+        "{ .a [ 1 2 ] } ( foo .b <.c 3> ) @macros .x ?y",
+        '."quoted key" 4 abc"de f" .empty ""  # comment',
+        '.escape-quote \'a""\\\'b\' .nl "a\\nb"',
+        "  .multi 'line\none\\\n' .after\ttab\n\n.last 1",
+        ".sql \"SELECT \\\"a\\\"\n  FROM 't'\n\n WHERE x = '\\\\n'\" .n 1",
+    ],
+)
+def test_tokenizers_agree(s):
+    j = JdotCoder()
+    # start is the column of the first character, end the column after the last
+    chars = [(t.type, t.string, t.kind, t.start, t.end) for t in j.tokenize_chars(s)]
+    regex = [(t.type, t.string, t.kind, t.start, t.end) for t in j.tokenize_regex(s)]
+    assert chars == regex
+
+
+@pytest.mark.parametrize("tokenizer", ["regex", "chars"])
+@pytest.mark.parametrize(
+    ("s", "out"),
+    [
+        ("1 -2 +3 007", [1, -2, 3, 7]),
+        ("1.5 -.5 2. 1e3 -1.5E-2", [1.5, -0.5, 2.0, 1000.0, -0.015]),
+        ("1_000 inf 1.5.2 5x x5 -", [1000, float("inf"), "1.5.2", "5x", "x5", "-"]),
+        ('[ 1 ] "3" .5 6', [[1], "3", {"5": 6}]),
+    ],
+)
+def test_decode_numbers(tokenizer, s, out):
+    d = JdotCoder(tokenizer=tokenizer).decode(s)
+    assert d == out
+    assert [type(x) for x in d] == [type(x) for x in out]
+
+
+@pytest.mark.parametrize("tokenizer", ["regex", "chars"])
+def test_decode_error(tokenizer):
+    j = JdotCoder(tokenizer=tokenizer)
+    with pytest.raises(DecodeException) as e:
+        j.decode(".a 1\n.b ( foo 2 )")
+    assert str(e.value) == "\n".join(
+        [
+            'ERROR: no macro named "foo" at line 2 (column 12)',
+            "> .b ( foo 2 )",
+            "             ^",
+        ]
+    )
+    assert str(j.toktuple) == ") (line 2, col 12)"
+
+
+@pytest.mark.parametrize("tokenizer", ["regex", "chars"])
+def test_decode_error_unterminated(tokenizer):
+    j = JdotCoder(tokenizer=tokenizer)
+    with pytest.raises(DecodeException) as e:
+        j.decode(".a 1\n.b ( zz")
+    assert str(e.value) == "\n".join(  # at the end of the input
+        [
+            'ERROR: no macro named "zz" at line 2 (column 8)',
+            "> .b ( zz",
+            "         ^",
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        '{ .a 1 } { .b "two\nlines" } 3 [ 4 5 ]',
+        "@macros .p { .x ?x .y ?y } @output (p 1 2) { .q (p 3 4) } @macros .z 0 @output z",
+        ".a 1 .b { .c 2 }",
+        "{ .a [ 1 2",
+    ],
+)
+def test_iterdecode_objects(s):
+    expected = JdotCoder().decode(s)
+    if not isinstance(expected, list):
+        expected = [expected]
+    for chunksize in (3, 7, 65536):
+        objs = JdotCoder().iterdecode_objects(io.StringIO(s), chunksize=chunksize)
+        assert list(objs) == expected
+
+
+def test_iterdecode_objects_incremental():
+    class Reader:
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        def read(self, n):
+            assert self.chunks, "read past the first record"
+            return self.chunks.pop(0)
+
+    objs = JdotCoder().iterdecode_objects(Reader(["{ .a 1 }\n"]))
+    assert next(objs) == dict(a=1)
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        '{ .a 1 } { .b "two\nlines" } 3 [ 4 5 ]',
+        "@macros .p { .x ?x .y ?y } @output (p 1 2)\n{ .q (p 3 4) } # (p 5 6)\n.r 'ü'",
+        ".a 1 .b { .c 2 }",
+    ],
+)
+def test_feed(s):
+    expected = JdotCoder().decode(s)
+    if not isinstance(expected, list):
+        expected = [expected]
+    data = s.encode("utf-8")
+    for n in (1, 2, 5):
+        j = JdotCoder()
+        objs = []
+        for i in range(0, len(data), n):
+            objs.extend(j.feed(data[i : i + n]))
+        objs.extend(j.close())
+        assert objs == expected
+
+
+def test_feed_incremental():
+    j = JdotCoder()
+    assert j.feed("{ .a 1 } { .b") == []
+    assert j.feed("\n") == [dict(a=1)]
+    assert j.feed(' "x') == []
+    assert j.feed('y" } 3\n4') == [dict(b="xy"), 3]
+    assert j.close() == [4]
+
+
+def test_async_roundtrip():
+    class Writer:
+        def __init__(self):
+            self.data = b""
+
+        def write(self, data):
+            self.data += data
+
+        async def drain(self):
+            pass
+
+    obj = [dict(a=[1, 2.5, "three"], b=dict(c=None, d=True)), "x y", {}]
+
+    async def roundtrip():
+        j = JdotCoder()
+        writer = Writer()
+        await j.aencode(obj, writer, chunksize=8)
+        reader = asyncio.StreamReader()
+        reader.feed_data(writer.data)
+        reader.feed_eof()
+        return writer.data, await j.adecode(reader, chunksize=5)
+
+    data, d = asyncio.run(roundtrip())
+    assert data.decode("utf-8") == JdotCoder().encode(obj)
+    assert d == obj
+
+
+def test_decode_cache(tmp_path):
+    macros = "@macros .p { .x ?x .y ?y } @output "
+    s = macros + "(p 1 2) [ (p 3 4) ]"
+    cache = DecodeCache(maxsize=2, directory=str(tmp_path))
+
+    j = JdotCoder(decode_cache=cache)
+    first = j.decode(s)
+    first[0]["x"] = "changed"
+    j2 = JdotCoder(decode_cache=cache)
+    d = j2.decode(s)
+    assert d == JdotCoder().decode(s)
+    assert d is not first
+    assert j2.encode_oneliner(j2.macros) == j.encode_oneliner(j.macros)
+    assert j2.encode_oneliner(dict(x=5, y=6)) == "( p 5 6 )"
+    assert cache.cache_info() == CacheInfo(1, 1, 0, 2, 1)
+
+    # same text, different macros in effect
+    assert j2.decode("(p 5 6)") == [dict(x=5, y=6)]
+    with pytest.raises(DecodeException):
+        JdotCoder(decode_cache=cache).decode("(p 5 6)")
+
+    # read back from disk in another process
+    cache = DecodeCache(directory=str(tmp_path))
+    assert JdotCoder(decode_cache=cache).decode(s) == d
+    assert cache.cache_info() == CacheInfo(1, 0, 1, 128, 1)
+
+    # hits that leave the macros as they were do not replace them
+    j.encode(dict(x=1, y=2))
+    index, version = j.macroindex, j.macros.version
+    assert j.decode("(p 7 8)") == j.decode("(p 7 8)") == [dict(x=7, y=8)]
+    assert j.decode_cache.cache_info().hits == 2
+    assert j.macros.version == version
+    j.encode(dict(x=1, y=2))
+    assert j.macroindex is index
+    j.macros["p"]["x"] = 0  # in place, and set again: the key changes
+    j.macros["p"] = j.macros["p"]
+    assert j.decode("(p 8)") == [dict(x=0, y=8)]
+
+
+@pytest.mark.parametrize(
+    ("macros", "args"),
+    [
+        ("@macros .m { .a [ 1 { .b ?b } ?c ] .d ? .e <.f 2.5> }", [1, 2]),
+        ("@macros .m [ ?a ? ?b ]", ["x", {"y": 1}]),
+        ("@macros .m ?a", [[1]]),
+        ("@macros .m 'const'", []),
+    ],
+)
+def test_compiled_macro(macros, args):
+    j = JdotCoder()
+    j.decode(macros)
+    expected = j.instantiate(j.macros["m"], list(args), "m")
+    out = j.instantiate_macro("m", list(args))
+    assert out == expected
+    assert type(out) is type(expected)
+    if isinstance(out, dict):
+        out["a"].append(3)  # constant parts are not shared between instances
+        assert j.instantiate_macro("m", list(args)) == expected
+
+
+def test_compiled_macro_changed():
+    j = JdotCoder()
+    j.decode("@macros .p { .a 1 .b ?b }")
+    assert j.decode("(p 5)") == [dict(a=1, b=5)]
+    j.macros["p"]["a"] = 2  # in place, between decodes
+    j.macros["p"] = j.macros["p"]  # set again, so that it is noticed
+    assert j.decode("(p 7)") == [dict(a=2, b=7)]
+
+    # not compiled while the macros are being defined
+    j = JdotCoder()
+    j.decode("@macros .p { .a ?a } .q (p 1) .r (p 2) @output (p 3)")
+    assert j.macros["q"] == dict(a=1)
+    assert list(j.compiled_macros) == ["p"]
+
+    # nor again for each decode with a header
+    compiled = j.compiled_macros["p"]
+    assert j.decode("@output (p 4)") == [dict(a=4)]
+    assert j.compiled_macros["p"] is compiled
+    j.decode("@macros .s 1")  # other macros changing does not matter either
+    assert j.decode("(p 5)") == [dict(a=5)]
+    assert j.compiled_macros["p"] is compiled
+
+
+@pytest.mark.parametrize(
+    ("s", "err"),
+    [
+        (
+            "@macros .p { .x ?x .y ?y } @output (p 1)",
+            'missing arg "y" for template "p"',
+        ),
+        ("@macros .p { .x ?x } @output (p 1 2)", 'too many args given to "p" [2]'),
+        ("@macros .p [ ?x ] .q (p 1) .p [ ?y ] .r (p 2)", 'missing arg "y"'),
+    ],
+)
+def test_macro_args_error(s, err):
+    with pytest.raises(DecodeException) as e:
+        JdotCoder().decode(s)
+    assert err in str(e.value)
+
+
+@pytest.mark.parametrize(
+    "d",
+    [
+        dict(a="b", c="d"),
+        dict(a="b", c="d", e=1),
+        dict(a="x", c="d"),
+        dict(c="d", e=1),
+        dict(e=[1, 2]),
+        {"": 1, "a": "b"},
+        [dict(a="b"), dict(c="d", f=dict(g=True)), dict(e=1.0)],
+    ],
+)
+def test_macro_index(d):
+    macros = """@macros .ab <.a "b"> .cd .c "d" .ce { .c ?c .e ?e } .e1 <.e 1>
+        .f <.f { .g true }>"""
+    j = JdotCoder()
+    j.decode(macros)
+    indexed = j.encode_oneliner(copy.deepcopy(d))
+
+    j.macroindex.candidates = lambda obj, start=0: [
+        (i, *item) for i, item in enumerate(j.macroindex.items) if i >= start
+    ]
+    assert indexed == j.encode_oneliner(d)
+
+
+def test_macro_index_changed():
+    j = JdotCoder()
+    j.decode("@macros .p { .a 1 .b ?b }")
+    assert j.encode_oneliner(dict(a=1, b=5)) == "( p 5 )"
+    j.macros["p"]["a"] = 2  # in place, between encodes
+    j.macros["p"] = j.macros["p"]  # set again, so that it is noticed
+    assert j.encode_oneliner(dict(a=2, b=5)) == "( p 5 )"
+    assert j.encode_oneliner(dict(a=1, b=5)) == ".a 1 .b 5"
+
+    index = j.macroindex  # kept while the macros are not changed
+    assert j.encode_oneliner(dict(a=2, b=6)) == "( p 6 )"
+    assert j.macroindex is index
+    j.macros["q"] = 1
+    assert j.encode_oneliner([dict(a=2, b=6), 1]) == "( p 6 ) q"
+    assert j.macroindex is not index
+
+
+@pytest.mark.parametrize(
+    "macro",
+    [
+        '{ .a ?x .b "b" }',
+        '< .a ?x .b "b" >',
+        "{ .a { .c ?y .d 1.5 } .b ? }",
+        "{ .a [ { .k ?v } ] .b ?x }",
+        "{ .a ?x .b ?x }",
+        "{ .a ?x . ? }",
+    ],
+)
+@pytest.mark.parametrize(
+    "obj",
+    [
+        dict(a=1, b="b"),
+        dict(a=1, b="c"),
+        dict(a=1, b="b", c=2),
+        {"a": 1, "b": "b", "": 2},
+        dict(a=dict(c=1, d=1.5), b=None),
+        dict(a=dict(c=1, d=1.5, e=0), b=None),
+        dict(a=[dict(k=1), dict(k=2)], b=3),
+        dict(a=[], b=3),
+    ],
+)
+def test_compiled_matcher(macro, obj):
+    j = JdotCoder()
+    j.decode("@macros .m " + macro)
+    template = j.macros["m"]
+    expected = deep_match(copy.deepcopy(obj), template)
+    assert CompiledMatcher(template).match(copy.deepcopy(obj)) == expected
+    unpickled = pickle.loads(pickle.dumps(CompiledMatcher(template)))
+    assert unpickled.match(copy.deepcopy(obj)) == expected
+    if unpickled.compiled:  # restored, with the builtins it calls
+        assert unpickled.match.__globals__["__builtins__"] is builtins
+
+
+@pytest.mark.parametrize("precompile", [True, False])
+def test_snapshot(precompile):
+    macros = """@macros
+        .point < .x ?x .y ?y >
+        .tagged { .tags [ ?tag ] .id ?id . ? }
+        .hi "hello there"
+        .box < .size < .w ?w .h ?h > >
+    """
+    j = JdotCoder(strict=True)
+    j.decode(macros)
+    objs = [dict(x=1, y="hello there", z=3), dict(tags=["a"], id=4, more=5)]
+    objs.append(dict(size=dict(w=1, h=2)))  # a nested dict, matched with isinstance
+    expected = j.encode_oneliner(objs)
+    assert "( point 1 hi )" in expected
+    assert "( box 1 2 )" in expected
+
+    fp = io.BytesIO()
+    j.dump_snapshot(fp, precompile=precompile)
+    fp.seek(0)
+    j2 = JdotCoder()
+    j2.load_snapshot(fp)
+    assert j2.options["strict"] is True
+    assert j2.macroindex.is_current(j2.macros)
+    assert j2.encode_oneliner(objs) == expected
+    assert j2.decode(expected) == JdotCoder().decode(macros + "@output " + expected)
+
+    with pytest.raises(SnapshotError):
+        snapshot.loads(b"@macros .a 1")
+
+
+def test_frozen_macros():
+    j = JdotCoder()
+    j.decode("@macros .point < .x ?x .y ?y > .pair [ ?a ?b ]")
+    frozen = j.freeze()
+    objs = [dict(x=i, y=i + 1, z=i % 3) for i in range(50)]
+    expected = j.encode_oneliner(objs)
+    decoded = j.decode("(point 1 2) (pair 3 4)")
+
+    def work(n):
+        c = frozen.coder()
+        for _ in range(n):
+            assert c.decode("@output (point 1 2) (pair 3 4)") == decoded
+            assert c.encode_oneliner(objs) == expected
+        return c
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        coders = list(pool.map(work, [20] * 8))
+    assert all(c.macroindex is frozen.macroindex for c in coders)
+
+    # defining macros copies the shared templates first
+    c = frozen.coder(strict=True)
+    c.decode("@macros .pair [ ?c ] .extra 3")
+    assert c.options["strict"] and not frozen.options["strict"]
+    assert c.frozen is None
+    assert repr(frozen.macros["pair"]) == "[?a, ?b]"
+    assert repr(c.macros["pair"]) == "[?a, ?b, [?c]]"
+    assert "extra" not in frozen.macros
+    assert frozen.coder().decode("(pair 1 2)") == [[1, 2]]
+
+
+@pytest.mark.parametrize("formatter", [None, "pretty"])
+def test_encode_parallel(formatter):
+    j = JdotCoder()
+    j.decode("@macros .point < .x ?x .y ?y > .rec { .id ?id . ? } .zero 0")
+    j.decode("@macros .nested < .a < .b ?x > >")  # matched with isinstance
+    objs = [dict(x=i, y=0, tags=["a", i], sub=dict(id=i, z=i)) for i in range(40)]
+    objs += [{}, [], 0, "s", [dict(x=1, y=2)], dict(a=dict(b=1, c=2))]
+    expected = j.encode(objs, formatter, "key")
+    assert "nested" in expected
+    out = j.encode_parallel(objs, 2, formatter, "key", chunksize=3)
+    assert out == expected
+
+
+@pytest.mark.parametrize("n", [3, 100])
+def test_deep_match_list(n):
+    items = [dict(name=f"n{i}", value=i) for i in range(n)] + [1, "x", [2], {"": 0}]
+    items += [dict(kind="k", id=1), dict(kind="k", id=2, more=3)]
+    assert deep_match(items, [dict(kind="k", id=Variable("id"))]) == dict(id=1)
+    assert deep_match(items, [InnerDict(kind="k", more=Variable("m"))]) == dict(m=3)
+    assert deep_match(items, [[Variable("l")], dict(x=1)]) == dict(l=2)
+    assert deep_match(items, [Variable("first"), 1]) == dict(first=items[0])
+    assert deep_match(items, [dict(name="n0", value=Variable("v"))]) == dict(v=0)
+    assert deep_match(items, [dict(kind="z", id=1), "x"]) is False
+
+    obj = dict(k=items)
+    deep_del(obj, dict(k=[dict(kind="k", id=Variable()), "x", 1, dict(kind="k", id=9)]))
+    assert obj["k"] == items[:n] + [[2], {"": 0}, dict(kind="k", id=2, more=3)]
+    assert len(items) == n + 6  # rebuilt, not changed in place
+    obj = dict(k=[1])
+    deep_del(obj, dict(k=[1, 1]))
+    assert obj == {}
+
+
+def test_encode_unchanged():
+    j = JdotCoder()
+    j.decode(
+        "@macros .size < .bounds < .w ?w .h ?h > > .tag < .tags [ { .k ?k } ] >"
+        " .meta < .meta { .id ?id . ? } >"
+    )
+    obj = dict(
+        bounds=dict(w=1, h=2, x=0),
+        tags=[dict(k="a"), dict(k="b")],
+        meta=dict(id=3, extra=dict(n=4)),
+        name="x",
+    )
+    objs = [obj, obj, dict(bounds=obj["bounds"], name="y")]
+    before = copy.deepcopy(objs)
+    s = j.encode_oneliner(objs)
+    assert objs == before
+    assert j.encode_oneliner(objs) == s
+    first = '{ ( size 1 2 ) ( tag "a" ) ( tag "b" ) ( meta 3 ) .bounds .x 0 .name "x" }'
+    assert s == " ".join([first, first, '{ ( size 1 2 ) .bounds .x 0 .name "y" }'])
+
+
+def test_mine_macros():
+    objs = [
+        dict(
+            kind="Pod",
+            id=i,
+            bounds=dict(x=i, y=0, w=10, h=20),
+            labels=dict(app="frontend-service", tier="web"),
+            tags=[1, 2],
+            **{"a key": True},
+        )
+        for i in range(50)
+    ]
+    text = mine_macros(objs)
+    j = JdotCoder()
+    j.decode(text)
+    assert deep_match(dict(h=20, w=10, x=3, y=0), j.macros["bounds"]) == dict(x=3)
+    assert j.macros["app"] == "frontend-service"
+    out = j.encode_oneliner(objs)
+    assert j.decode(out) == objs
+    assert len(out) < len(JdotCoder().encode_oneliner(objs)) / 4
+
+    miner = MacroMiner()
+    for obj in objs:
+        miner.add(obj)
+    mined = miner.macros(2)
+    assert [m.name for m in mined] == ["m", "labels"]
+    assert mined[0].count == 50
+    assert mined[0].savings > mined[1].savings > 0
+    assert miner.size == sum(len(JdotCoder().encode_oneliner(x)) for x in objs)
+
+    # bounded, however many shapes
+    miner = MacroMiner(capacity=10)
+    for i in range(100):
+        miner.add([dict(bounds=dict(x=1, y=2)), {f"k{i}": i}])
+        assert len(miner.shapes) <= 10
+    assert [m.template for m in miner.macros()] == [
+        "{ .bounds { .x 1 .y 2 } }",
+        "{ .x 1 .y 2 }",
+    ]
+
+
+def test_iterjson():
+    text = '{"a": [1, 2]}\n12 "x"\n\n[]{"b":\n null}\n  3.5'
+    assert list(iterjson(io.StringIO(text), chunksize=3)) == [
+        dict(a=[1, 2]),
+        12,
+        "x",
+        [],
+        dict(b=None),
+        3.5,
+    ]
+
+
+def test_scalar_macros():
+    j = JdotCoder()
+    j.decode('@macros .yes true .one 1 .half 0.5 .zero 0.0 .s "long string"')
+    objs = [True, 1, 1.0, False, 0.5, 0.0, -0.0, "long string", "1", None]
+    out = j.encode_oneliner(objs)
+    assert out == 'yes one 1.0 false half zero -0.0 s "1" null'
+    assert j.decode(out) == objs
+    assert [type(x) for x in j.decode(out)] == [type(x) for x in objs]
+
+    # no lookups at all without scalar macros, so unhashable leaves are fine
+    j = JdotCoder()
+    j.decode("@macros .m < .a ?a >")
+    assert j.revmacros == {}
+    assert j.encode_oneliner([frozenset(), 2]) == "frozenset() 2"
+
+
+def test_match_memo():
+    macros = (
+        "@macros .size < .bounds < .w ?w .h ?h > > .label { .k ?k .v ?v }"
+        " .flag < .on true > .one < .n 1 >"
+    )
+    bounds = dict(w=1, h=2, x=0)
+    objs = [
+        dict(bounds=bounds, on=True, n=1),
+        dict(bounds=dict(w=1, h=2, x=0), on=True, n=1),
+        dict(bounds=dict(w=1, h=2, x=0), on=1, n=True),
+        dict(bounds=dict(w=1, h=2, x=-0.0), on=True, n=1.0),
+        dict(k="a", v=[dict(k="b", v=None)]),
+        dict(k="a", v=[dict(k="b", v=None)]),
+    ]
+    j = JdotCoder()
+    j.decode(macros)
+    expected = j.encode(objs, "pretty")
+
+    j = JdotCoder(match_memo=100)
+    j.decode(macros)
+    assert j.encode(objs, "pretty") == expected
+    hits, misses, maxsize, currsize = j.match_memo_info
+    assert (hits, maxsize) == (5, 100)
+    plain = JdotCoder()
+    plain.decode(macros)
+    assert j.encode(objs * 3, "pretty") == plain.encode(objs * 3, "pretty")
+    assert j.match_memo_info.misses == misses
+
+
+def test_match_memo_bounded():
+    memo = _MatchMemo(2)
+    objs = [dict(a=i, b=[dict(c=i)]) for i in range(100)]
+    for obj in objs:  # as the encoder gets to each
+        assert memo.key(obj) is not None
+        memo.done(obj["b"])
+        assert memo.key(obj["b"][0]) is not None
+    assert memo.ids == {}
+    assert len(memo.structures) == 8
+    assert memo.key(dict(a=99, b=[dict(c=99)])) == memo.key(objs[99])
+
+    j = JdotCoder(match_memo=2)
+    j.decode("@macros .m < .a ?a >")
+    plain = JdotCoder()
+    plain.decode("@macros .m < .a ?a >")
+    assert j.encode(objs * 2) == plain.encode(objs * 2)
+
+
+def test_encode_deep():
+    depth = sys.getrecursionlimit() * 2
+    obj = inner = {}
+    for i in range(depth):
+        inner["a"] = [{"b": i}]
+        inner = inner["a"][0]
+    j = JdotCoder()
+    s = j.encode_oneliner(obj)
+    assert s.startswith(".a [ { .b 0 .a [ { .b 1 .a")
+    assert j.encode_oneliner(j.decode(s)) == s
+
+
+@pytest.mark.parametrize("brackets", ["{}", "<>"])
+def test_macro_deep(brackets):
+    depth = sys.getrecursionlimit() * 2
+    opening, closing = brackets
+    j = JdotCoder()
+    j.decode(
+        f"@macros .m {opening} .a " + "{ .a " * depth + "?x" + " }" * depth + closing
+    )
+    assert j.encode_oneliner(j.decode("@output (m 1)")) == "( m 1 )"
+
+    j = JdotCoder()
+    j.decode(f"@macros .m {opening} .a ?x {closing}")
+    s = ".b " + "( m " * depth + "1" + " )" * depth
+    assert j.encode_oneliner(j.decode(s)) == s
+
+
+@pytest.mark.parametrize("formatter", [None, "pretty", " ".join])
+def test_dump(formatter):
+    j = JdotCoder()
+    j.decode("@macros .m <.k ?v>")
+    obj = [dict(k=i, a=[1, 2, dict(b="x y")], c=dict(d=None)) for i in range(20)]
+    fp = io.StringIO()
+    j.dump(obj, fp, formatter, chunksize=16)
+    assert fp.getvalue() == j.encode(obj, formatter)
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        ".a [ 1 2 3 4 5 6 ] .b { .c 1 }",
+        "@macros .m { .a ?x } # comment\n @output ( m 1 ) ( m [ 2 ] )",
+        "{ .a [ 1 { .b 2 } ] } }",
+        "{ .a [ 1",
+    ],
+)
+def test_iterformat(s):
+    tokens = s.split(" ")
+    formatter = JdotFormatter(dedent_last_value=True)
+    assert "".join(formatter.iterformat(iter(tokens))) == formatter(tokens)
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        ".a [ 1 2 3 4 5 6 ] .b { .c 1 }",
+        "@macros .m { .a ?x } # comment\n @output ( m 1 ) ( m [ 2 ] )",
+        "{ .a [ 1 { .b 2 } ] } }",
+        "{ .a [ 1",
+        "( m { .a 1 .b 2 } ) .c [ [ 1 2 ] [ 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 ] ]",
+    ],
+)
+@pytest.mark.parametrize("dedent", [False, True])
+def test_stream_formatter(s, dedent):
+    tokens = s.split(" ")
+    expected = JdotFormatter(dedent_last_value=dedent)(tokens)
+    assert JdotStreamFormatter(dedent_last_value=dedent)(iter(tokens)) == expected
+
+
+def test_stream_formatter_lookahead():
+    tokens = ".a [ 1 2 3 4 5 6 7 8 9 ] .b 2".split(" ")
+    items = "".join(f"\n  {i}" for i in range(1, 10))
+    assert JdotFormatter()(tokens) == f".a [{items}\n]\n.b 2\n"
+    # can't see past the list, so takes it to be the last value
+    assert JdotStreamFormatter(lookahead=5)(tokens) == f".a [{items}\n] .b 2\n"
+
+
+def test_formatter_measured_groups():
+    f = JdotFormatter(value_limit=3, length_limit=20)
+    for s in [
+        ".a [ 1 2 ]",
+        ".a [ 1 2 3 ]",
+        ".a { .b [ 1 ] .c 2 }",
+        ".a ( m 1 )",
+        ".a [ # c\n 1 ]",
+        ".a [ 'a long string value' ]",
+        "[ [ 1 ] [ 2 ] ]",
+    ]:
+        for group in f._preprocess(s.split(" ")):
+            if isinstance(group, list):
+                for is_macro in (False, True):
+                    f._reset()
+                    measured = f._should_wrap(group, is_macro)
+                    f._reset()
+                    assert measured == f._should_wrap(list(group), is_macro), s
+
+    # a wide group is measured once, rather than once per value
+    tokens = [".a", "["] + [str(i) for i in range(100000)] + ["]"]
+    f = JdotFormatter(value_limit=10**6, length_limit=10**7)
+    assert f(tokens) == ".a [ " + " ".join(tokens[2:-1]) + " ]\n"